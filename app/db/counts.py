@@ -0,0 +1,74 @@
+"""
+Users counts per status shared by the system stats endpoint and the bots,
+cached for a few seconds since the dashboard polls them continuously.
+"""
+
+import time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.db import crud, events
+from app.db.models import Admin, User
+from app.utils.metrics import metrics
+from config import USERS_COUNTS_CACHE_TTL
+
+
+class UsersCountsCache:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries: Dict[Optional[int], Tuple[float, Dict[str, int]]] = {}
+        self._generation = 0  # increased on clear, so counts loaded before it aren't stored
+
+    def get(self, db: Session, admin: Optional[Admin] = None) -> Dict[str, int]:
+        """
+        Returns the count of users per status and of the online users.
+
+        Args:
+            db (Session): Database session.
+            admin (Optional[Admin]): Admin to count the users of, all users if not given.
+
+        Returns:
+            Dict[str, int]: Count of users per status value, and the "total" and "online" counts.
+        """
+        key = admin.id if admin else None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+        if entry and now - entry[0] < self.ttl:
+            metrics.inc("users_counts_cache_hits")
+            return dict(entry[1])
+
+        metrics.inc("users_counts_cache_misses")
+        counts = crud.get_users_counts(db, admin=admin)
+        if self.ttl > 0:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[key] = (now, counts)
+        return dict(counts)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+users_counts = UsersCountsCache(USERS_COUNTS_CACHE_TTL)
+
+
+@events.user_updated.connect
+def _on_user_updated(dbuser: User):
+    users_counts.clear()
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: User):
+    users_counts.clear()
+
+
+@events.users_updated.connect
+def _on_users_updated():
+    users_counts.clear()
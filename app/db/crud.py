@@ -2,14 +2,18 @@
 Functions for managing proxy hosts, users, user templates, nodes, and administrative tasks.
 """
 
+import base64
+import json
+from collections import defaultdict
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-from sqlalchemy import and_, delete, func, or_
-from sqlalchemy.orm import Query, Session, joinedload
+from sqlalchemy import and_, case, delete, func, or_, select, update
+from sqlalchemy.orm import Query, Session, joinedload, selectinload
 from sqlalchemy.sql.functions import coalesce
 
+from app.db import events
 from app.db.models import (
     JWT,
     TLS,
@@ -17,8 +21,10 @@ from app.db.models import (
     AdminUsageLogs,
     NextPlan,
     Node,
-    NodeUsage,
-    NodeUserUsage,
+    NodeUsageDaily,
+    NodeUsageMonthly,
+    NodeUserUsageDaily,
+    NodeUserUsageMonthly,
     NotificationReminder,
     Proxy,
     ProxyHost,
@@ -29,6 +35,8 @@ from app.db.models import (
     UserTemplate,
     UserUsageResetLogs,
 )
+from app.db.retention import retention
+from app.db.usage import NODE_USAGE_TABLES, USER_USAGE_TABLES, usage_ranges
 from app.models.admin import AdminCreate, AdminModify, AdminPartialModify
 from app.models.node import NodeCreate, NodeModify, NodeStatus, NodeUsageResponse
 from app.models.proxy import ProxyHost as ProxyHostModify
@@ -220,17 +228,133 @@ UsersSortingOptions = Enum('UsersSortingOptions', {
     '-created_at': User.created_at.desc(),
 })
 
+# columns users can be paginated by with a cursor, and whether they are nullable,
+# NULLs are sorted as the smallest values on every database
+USERS_CURSOR_COLUMNS = {
+    'id': (User.id, False),
+    'username': (User.username, False),
+    'used_traffic': (User.used_traffic, False),
+    'data_limit': (User.data_limit, True),
+    'expire': (User.expire, True),
+    'created_at': (User.created_at, False),
+}
+
+# fields of the users which can be fetched alone, without loading the users
+USER_FIELDS = {
+    'username': User.username,
+    'status': User.status,
+    'used_traffic': User.used_traffic,
+    'lifetime_used_traffic': User.lifetime_used_traffic,
+    'data_limit': User.data_limit,
+    'data_limit_reset_strategy': User.data_limit_reset_strategy,
+    'expire': User.expire,
+    'note': User.note,
+    'sub_updated_at': User.sub_updated_at,
+    'sub_last_user_agent': User.sub_last_user_agent,
+    'online_at': User.online_at,
+    'on_hold_expire_duration': User.on_hold_expire_duration,
+    'on_hold_timeout': User.on_hold_timeout,
+    'auto_delete_in_days': User.auto_delete_in_days,
+    'created_at': User.created_at,
+}
+
+
+def _get_cursor_sort(sort: Optional[List[UsersSortingOptions]]) -> Optional[Tuple[str, bool]]:
+    """Returns the column name and direction users are paginated by, None if the sorting doesn't support cursors."""
+    if not sort:
+        return 'id', False
+    if len(sort) > 1:
+        return None
+    name = sort[0].name
+    return name.lstrip('-'), name.startswith('-')
+
+
+def get_users_cursor(user: Union[User, Any], sort: Optional[List[UsersSortingOptions]] = None) -> Optional[str]:
+    """
+    Creates the cursor of the page of users following the given user.
+
+    Args:
+        user (Union[User, Any]): The last user of a page, or its row when only some fields were fetched.
+        sort (Optional[List[UsersSortingOptions]]): Sorting options of the page.
+
+    Returns:
+        Optional[str]: The cursor, None if the sorting doesn't support cursors.
+    """
+    cursor_sort = _get_cursor_sort(sort)
+    if cursor_sort is None:
+        return None
+
+    name, _ = cursor_sort
+    value = getattr(user, name)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([name, value, user.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _filter_after_cursor(query: Query, cursor: str, sort: Optional[List[UsersSortingOptions]]) -> Query:
+    cursor_sort = _get_cursor_sort(sort)
+    if cursor_sort is None:
+        raise ValueError("Cursors can only be used with a single sort option")
+
+    try:
+        name, value, last_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if name != cursor_sort[0] or not isinstance(last_id, int):
+        raise ValueError("Cursor doesn't match the sort option")
+
+    column, nullable = USERS_CURSOR_COLUMNS[name]
+    desc = cursor_sort[1]
+    if name == 'created_at' and value is not None:
+        try:
+            value = datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+
+    next_id = User.id < last_id if desc else User.id > last_id
+    if value is None:
+        # ascending pages start with the NULLs, descending pages end with them
+        cond = and_(column.is_(None), next_id)
+        return query.filter(cond if desc else or_(cond, column.isnot(None)))
+
+    cond = or_(column < value if desc else column > value, and_(column == value, next_id))
+    if desc and nullable:
+        cond = or_(cond, column.is_(None))
+    return query.filter(cond)
+
+
+def _order_users(query: Query, sort: Optional[List[UsersSortingOptions]]) -> Query:
+    cursor_sort = _get_cursor_sort(sort)
+    if cursor_sort is None:
+        return query.order_by(*(opt.value for opt in sort))
+
+    # ordered by id within equal values, so cursors are unambiguous
+    name, desc = cursor_sort
+    column, nullable = USERS_CURSOR_COLUMNS[name]
+    order = []
+    if nullable:
+        order.append(column.is_(None).asc() if desc else column.is_(None).desc())
+    order.append(column.desc() if desc else column.asc())
+    if name != 'id':
+        order.append(User.id.desc() if desc else User.id.asc())
+    return query.order_by(*order)
+
 
 def get_users(db: Session,
               offset: Optional[int] = None,
               limit: Optional[int] = None,
               usernames: Optional[List[str]] = None,
+              ids: Optional[List[int]] = None,
               search: Optional[str] = None,
               status: Optional[Union[UserStatus, list]] = None,
               sort: Optional[List[UsersSortingOptions]] = None,
               admin: Optional[Admin] = None,
               admins: Optional[List[str]] = None,
               reset_strategy: Optional[Union[UserDataLimitResetStrategy, list]] = None,
+              cursor: Optional[str] = None,
+              fields: Optional[List[str]] = None,
+              load_relations: bool = False,
               return_with_count: bool = False) -> Union[List[User], Tuple[List[User], int]]:
     """
     Retrieves users based on various filters and options.
@@ -240,48 +364,75 @@ def get_users(db: Session,
         offset (Optional[int]): Number of records to skip.
         limit (Optional[int]): Number of records to retrieve.
         usernames (Optional[List[str]]): List of usernames to filter by.
+        ids (Optional[List[int]]): List of user IDs to filter by.
         search (Optional[str]): Search term to filter by username or note.
         status (Optional[Union[UserStatus, list]]): User status or list of statuses to filter by.
         sort (Optional[List[UsersSortingOptions]]): Sorting options.
         admin (Optional[Admin]): Admin to filter users by.
         admins (Optional[List[str]]): List of admin usernames to filter users by.
         reset_strategy (Optional[Union[UserDataLimitResetStrategy, list]]): Data limit reset strategy to filter by.
+        cursor (Optional[str]): Cursor of the page to retrieve, from get_users_cursor.
+        fields (Optional[List[str]]): Fields of USER_FIELDS to retrieve instead of the users.
+        load_relations (bool): Whether to load the proxies of the users in batches.
         return_with_count (bool): Whether to return the total count of users.
 
     Returns:
-        Union[List[User], Tuple[List[User], int]]: List of users or tuple of users and total count.
+        Union[List[User], Tuple[List[User], int]]: List of users or tuple of users and total count,
+            rows with the id and the given fields instead of users if fields are given.
+
+    Raises:
+        ValueError: If the cursor is invalid or doesn't match the sorting options.
     """
-    query = get_user_queryset(db)
+    filters = []
 
     if search:
-        query = query.filter(or_(User.username.ilike(f"%{search}%"), User.note.ilike(f"%{search}%")))
+        filters.append(or_(User.username.ilike(f"%{search}%"), User.note.ilike(f"%{search}%")))
 
     if usernames:
-        query = query.filter(User.username.in_(usernames))
+        filters.append(User.username.in_(usernames))
+
+    if ids:
+        filters.append(User.id.in_(ids))
 
     if status:
         if isinstance(status, list):
-            query = query.filter(User.status.in_(status))
+            filters.append(User.status.in_(status))
         else:
-            query = query.filter(User.status == status)
+            filters.append(User.status == status)
 
     if reset_strategy:
         if isinstance(reset_strategy, list):
-            query = query.filter(User.data_limit_reset_strategy.in_(reset_strategy))
+            filters.append(User.data_limit_reset_strategy.in_(reset_strategy))
         else:
-            query = query.filter(User.data_limit_reset_strategy == reset_strategy)
+            filters.append(User.data_limit_reset_strategy == reset_strategy)
 
     if admin:
-        query = query.filter(User.admin == admin)
+        filters.append(User.admin == admin)
 
     if admins:
-        query = query.filter(User.admin.has(Admin.username.in_(admins)))
+        filters.append(User.admin.has(Admin.username.in_(admins)))
 
     if return_with_count:
-        count = query.count()
+        count = db.query(func.count(User.id)).filter(*filters).scalar()
+
+    if fields:
+        columns = {'id': User.id, **{name: USER_FIELDS[name] for name in fields}}
+        cursor_sort = _get_cursor_sort(sort)
+        if cursor_sort and cursor_sort[0] not in columns:
+            # needed for the cursor of the next page
+            columns[cursor_sort[0]] = USERS_CURSOR_COLUMNS[cursor_sort[0]][0]
+        query = db.query(*(column.label(name) for name, column in columns.items()))
+    else:
+        query = get_user_queryset(db)
+        if load_relations:
+            query = query.options(selectinload(User.proxies).selectinload(Proxy.excluded_inbounds))
 
-    if sort:
-        query = query.order_by(*(opt.value for opt in sort))
+    query = query.filter(*filters)
+
+    if cursor:
+        query = _filter_after_cursor(query, cursor, sort)
+
+    query = _order_users(query, sort)
 
     if offset:
         query = query.offset(offset)
@@ -294,6 +445,26 @@ def get_users(db: Session,
     return query.all()
 
 
+def _sum_usages_per_node(db: Session, tables: dict, columns: List[str], start: datetime, end: datetime,
+                         filters: Callable[[Any], list] = lambda model: []) -> Dict[int, List[int]]:
+    """
+    Sums usage columns per node (0 for the main core) between start and end, reading
+    whole months and days from the rollup tables and only the remaining hours from the hourly rows.
+    """
+    totals = defaultdict(lambda: [0] * len(columns))
+    ranges = usage_ranges(start, end, retention.hourly_since(), retention.daily_since())
+    for resolution, range_start, range_end in ranges:
+        model = tables[resolution]
+        query = db.query(model.node_id, *(func.sum(getattr(model, column)) for column in columns)) \
+            .filter(model.created_at >= range_start, model.created_at < range_end, *filters(model)) \
+            .group_by(model.node_id)
+        for node_id, *sums in query:
+            total = totals[node_id or 0]
+            for i, value in enumerate(sums):
+                total[i] += int(value or 0)
+    return totals
+
+
 def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -> List[UserUsageResponse]:
     """
     Retrieves user usages within a specified date range.
@@ -321,15 +492,11 @@ def get_user_usages(db: Session, dbuser: User, start: datetime, end: datetime) -
             used_traffic=0
         )
 
-    cond = and_(NodeUserUsage.user_id == dbuser.id,
-                NodeUserUsage.created_at >= start,
-                NodeUserUsage.created_at <= end)
-
-    for v in db.query(NodeUserUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
-        except KeyError:
-            pass
+    totals = _sum_usages_per_node(db, USER_USAGE_TABLES, ['used_traffic'], start, end,
+                                  lambda model: [model.user_id == dbuser.id])
+    for node_id, (used_traffic,) in totals.items():
+        if node_id in usages:
+            usages[node_id].used_traffic += used_traffic
 
     return list(usages.values())
 
@@ -354,6 +521,33 @@ def get_users_count(db: Session, status: UserStatus = None, admin: Admin = None)
     return query.count()
 
 
+def get_users_counts(db: Session, admin: Admin = None, online_hours: int = 24) -> Dict[str, int]:
+    """
+    Retrieves the count of users per status and of the online users in a single query.
+
+    Args:
+        db (Session): Database session.
+        admin (Admin, optional): Admin to filter users by.
+        online_hours (int): Hours since the last activity of users counted as online.
+
+    Returns:
+        Dict[str, int]: Count of users per status value, and the "total" and "online" counts.
+    """
+    online_since = datetime.utcnow() - timedelta(hours=online_hours)
+    online = func.sum(case((User.online_at >= online_since, 1), else_=0))
+    query = db.query(User.status, func.count(User.id), online)
+    if admin:
+        query = query.filter(User.admin == admin)
+
+    counts = {status.value: 0 for status in UserStatus}
+    counts.update(total=0, online=0)
+    for status, count, online_count in query.group_by(User.status):
+        counts[UserStatus(status).value] = count
+        counts["total"] += count
+        counts["online"] += int(online_count or 0)
+    return counts
+
+
 def create_user(db: Session, user: UserCreate, admin: Admin = None) -> User:
     """
     Creates a new user with provided details.
@@ -400,6 +594,7 @@ def create_user(db: Session, user: UserCreate, admin: Admin = None) -> User:
     db.add(dbuser)
     db.commit()
     db.refresh(dbuser)
+    events.user_updated.send(dbuser)
     return dbuser
 
 
@@ -416,6 +611,7 @@ def remove_user(db: Session, dbuser: User) -> User:
     """
     db.delete(dbuser)
     db.commit()
+    events.user_removed.send(dbuser)
     return dbuser
 
 
@@ -430,6 +626,8 @@ def remove_users(db: Session, dbusers: List[User]):
     for dbuser in dbusers:
         db.delete(dbuser)
     db.commit()
+    for dbuser in dbusers:
+        events.user_removed.send(dbuser)
     return
 
 
@@ -529,6 +727,7 @@ def update_user(db: Session, dbuser: User, modify: UserModify) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    events.user_updated.send(dbuser)
     return dbuser
 
 
@@ -549,8 +748,11 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
     )
     db.add(usage_log)
 
+    # the reset traffic stays in lifetime_used_traffic
     dbuser.used_traffic = 0
     dbuser.node_usages.clear()
+    dbuser.node_usages_daily.clear()
+    dbuser.node_usages_monthly.clear()
     if dbuser.status not in (UserStatus.expired or UserStatus.disabled):
         dbuser.status = UserStatus.active.value
 
@@ -561,6 +763,8 @@ def reset_user_data_usage(db: Session, dbuser: User) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    events.usage_reset.send([dbuser.id])
+    events.user_updated.send(dbuser)
     return dbuser
 
 
@@ -586,12 +790,15 @@ def reset_user_by_next(db: Session, dbuser: User) -> User:
     db.add(usage_log)
 
     dbuser.node_usages.clear()
+    dbuser.node_usages_daily.clear()
+    dbuser.node_usages_monthly.clear()
     dbuser.status = UserStatus.active.value
 
     dbuser.data_limit = dbuser.next_plan.data_limit + \
         (0 if dbuser.next_plan.add_remaining_traffic else dbuser.data_limit - dbuser.used_traffic)
     dbuser.expire = dbuser.next_plan.expire
 
+    # the reset traffic stays in lifetime_used_traffic
     dbuser.used_traffic = 0
     db.delete(dbuser.next_plan)
     dbuser.next_plan = None
@@ -599,6 +806,8 @@ def reset_user_by_next(db: Session, dbuser: User) -> User:
 
     db.commit()
     db.refresh(dbuser)
+    events.usage_reset.send([dbuser.id])
+    events.user_updated.send(dbuser)
     return dbuser
 
 
@@ -659,18 +868,25 @@ def reset_all_users_data_usage(db: Session, admin: Optional[Admin] = None):
     if admin:
         query = query.filter(User.admin == admin)
 
-    for dbuser in query.all():
+    dbusers = query.all()
+    for dbuser in dbusers:
         dbuser.used_traffic = 0
+        dbuser.lifetime_used_traffic = 0  # the reset logs are dropped too
         if dbuser.status not in [UserStatus.on_hold, UserStatus.expired, UserStatus.disabled]:
             dbuser.status = UserStatus.active
         dbuser.usage_logs.clear()
         dbuser.node_usages.clear()
+        dbuser.node_usages_daily.clear()
+        dbuser.node_usages_monthly.clear()
         if dbuser.next_plan:
             db.delete(dbuser.next_plan)
             dbuser.next_plan = None
         db.add(dbuser)
 
+    user_ids = [dbuser.id for dbuser in dbusers] if admin else None
     db.commit()
+    events.usage_reset.send(user_ids, lifetime=True)
+    events.users_updated.send()
 
 
 def disable_all_active_users(db: Session, admin: Optional[Admin] = None):
@@ -688,6 +904,7 @@ def disable_all_active_users(db: Session, admin: Optional[Admin] = None):
     query.update({User.status: UserStatus.disabled, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
 
     db.commit()
+    events.users_updated.send()
 
 
 def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
@@ -714,6 +931,7 @@ def activate_all_disabled_users(db: Session, admin: Optional[Admin] = None):
         {User.status: UserStatus.active, User.last_status_change: datetime.utcnow()}, synchronize_session=False)
 
     db.commit()
+    events.users_updated.send()
 
 
 def autodelete_expired_users(db: Session,
@@ -788,19 +1006,15 @@ def get_all_users_usages(
             used_traffic=0
         )
 
-    admin_users = set(user.id for user in get_users(db=db, admins=admin))
+    def filters(model) -> list:
+        if not admin:
+            return [model.user_id.isnot(None)]
+        return [model.user_id.in_(select(User.id).where(User.admin.has(Admin.username.in_(admin))))]
 
-    cond = and_(
-        NodeUserUsage.created_at >= start,
-        NodeUserUsage.created_at <= end,
-        NodeUserUsage.user_id.in_(admin_users)
-    )
-
-    for v in db.query(NodeUserUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].used_traffic += v.used_traffic
-        except KeyError:
-            pass
+    totals = _sum_usages_per_node(db, USER_USAGE_TABLES, ['used_traffic'], start, end, filters)
+    for node_id, (used_traffic,) in totals.items():
+        if node_id in usages:
+            usages[node_id].used_traffic += used_traffic
 
     return list(usages.values())
 
@@ -821,9 +1035,157 @@ def update_user_status(db: Session, dbuser: User, status: UserStatus) -> User:
     dbuser.last_status_change = datetime.utcnow()
     db.commit()
     db.refresh(dbuser)
+    events.user_updated.send(dbuser)
     return dbuser
 
 
+def get_limited_user_ids(db: Session, user_ids: List[int]) -> List[int]:
+    """
+    Retrieves IDs of active users without a next plan who reached their data limit.
+
+    Args:
+        db (Session): Database session.
+        user_ids (List[int]): IDs of the users to check.
+
+    Returns:
+        List[int]: IDs of the limited users.
+    """
+    query = db.query(User.id).filter(User.id.in_(user_ids), *limited_users_filter())
+    return [row[0] for row in query]
+
+
+def limited_users_filter() -> list:
+    """Conditions of the active users without a next plan who reached their data limit."""
+    return [
+        User.status == UserStatus.active,
+        User.data_limit > 0,
+        User.used_traffic >= User.data_limit,
+        ~User.next_plan.has()
+    ]
+
+
+def get_expired_user_ids(db: Session, user_ids: List[int], now: datetime) -> List[int]:
+    """
+    Retrieves IDs of active users without a next plan whose expiration time has passed.
+
+    Args:
+        db (Session): Database session.
+        user_ids (List[int]): IDs of the users to check.
+        now (datetime): Current time (UTC).
+
+    Returns:
+        List[int]: IDs of the expired users.
+    """
+    query = db.query(User.id).filter(User.id.in_(user_ids), *expired_users_filter(now))
+    return [row[0] for row in query]
+
+
+def expired_users_filter(now: datetime) -> list:
+    """Conditions of the active users without a next plan whose expiration time has passed."""
+    return [
+        User.status == UserStatus.active,
+        User.expire > 0,
+        User.expire <= now.timestamp(),
+        ~User.next_plan.has()
+    ]
+
+
+def get_next_plan_user_ids(db: Session, user_ids: List[int], now: datetime) -> List[int]:
+    """
+    Retrieves IDs of active users with a next plan who are limited or expired.
+
+    Args:
+        db (Session): Database session.
+        user_ids (List[int]): IDs of the users to check.
+        now (datetime): Current time (UTC).
+
+    Returns:
+        List[int]: IDs of the users whose next plan may have to be applied.
+    """
+    query = db.query(User.id).filter(
+        User.id.in_(user_ids),
+        User.status == UserStatus.active,
+        or_(
+            and_(User.data_limit > 0, User.used_traffic >= User.data_limit),
+            and_(User.expire > 0, User.expire <= now.timestamp())
+        ),
+        User.next_plan.has()
+    )
+    return [row[0] for row in query]
+
+
+def get_on_hold_user_ids_to_activate(db: Session, user_ids: List[int], now: datetime) -> List[int]:
+    """
+    Retrieves IDs of on-hold users who connected after the last edit or whose on-hold timeout has passed.
+
+    Args:
+        db (Session): Database session.
+        user_ids (List[int]): IDs of the users to check.
+        now (datetime): Current time (UTC).
+
+    Returns:
+        List[int]: IDs of the users to activate.
+    """
+    query = db.query(User.id).filter(User.id.in_(user_ids), *on_hold_users_to_activate_filter(now))
+    return [row[0] for row in query]
+
+
+def on_hold_users_to_activate_filter(now: datetime) -> list:
+    """Conditions of the on-hold users who connected after the last edit or whose on-hold timeout has passed."""
+    return [
+        User.status == UserStatus.on_hold,
+        or_(
+            User.online_at >= coalesce(User.edit_at, User.created_at),
+            User.on_hold_timeout <= now
+        )
+    ]
+
+
+def update_users_status(db: Session, user_ids: List[int], status: UserStatus,
+                        filters: Optional[list] = None, start_expire: bool = False) -> List[User]:
+    """
+    Updates the status of multiple users in a single statement.
+
+    Args:
+        db (Session): Database session.
+        user_ids (List[int]): IDs of the users to update.
+        status (UserStatus): The new status.
+        filters (Optional[list]): Conditions the users must still match, users changed
+            since they were selected are left as they are.
+        start_expire (bool): Whether to also start the expiration timer of on-hold users.
+
+    Returns:
+        List[User]: The updated user objects.
+    """
+    if not user_ids:
+        return []
+
+    now = datetime.utcnow()
+    values = {"status": status, "last_status_change": now}
+    if start_expire:
+        values.update(
+            expire=int(now.timestamp()) + User.on_hold_expire_duration,
+            on_hold_expire_duration=None,
+            on_hold_timeout=None
+        )
+
+    # users changed since they were selected (e.g. reset by an admin) no longer match the filters
+    filters = filters or []
+    user_ids = [row[0] for row in db.query(User.id).filter(User.id.in_(user_ids), *filters).with_for_update()]
+    if not user_ids:
+        db.commit()
+        return []
+
+    db.execute(update(User).where(User.id.in_(user_ids), *filters).values(**values),
+               execution_options={"synchronize_session": False})
+    db.commit()
+
+    dbusers = get_users(db, ids=user_ids)
+    for dbuser in dbusers:
+        events.user_updated.send(dbuser)
+    return dbusers
+
+
 def set_owner(db: Session, dbuser: User, admin: Admin) -> User:
     """
     Sets the owner (admin) of a user.
@@ -839,6 +1201,7 @@ def set_owner(db: Session, dbuser: User, admin: Admin) -> User:
     dbuser.admin = admin
     db.commit()
     db.refresh(dbuser)
+    events.user_updated.send(dbuser)
     return dbuser
 
 
@@ -859,6 +1222,7 @@ def start_user_expire(db: Session, dbuser: User) -> User:
     dbuser.on_hold_timeout = None
     db.commit()
     db.refresh(dbuser)
+    events.user_updated.send(dbuser)
     return dbuser
 
 
@@ -1281,14 +1645,11 @@ def get_nodes_usage(db: Session, start: datetime, end: datetime) -> List[NodeUsa
             downlink=0
         )
 
-    cond = and_(NodeUsage.created_at >= start, NodeUsage.created_at <= end)
-
-    for v in db.query(NodeUsage).filter(cond):
-        try:
-            usages[v.node_id or 0].uplink += v.uplink
-            usages[v.node_id or 0].downlink += v.downlink
-        except KeyError:
-            pass
+    totals = _sum_usages_per_node(db, NODE_USAGE_TABLES, ['uplink', 'downlink'], start, end)
+    for node_id, (uplink, downlink) in totals.items():
+        if node_id in usages:
+            usages[node_id].uplink += uplink
+            usages[node_id].downlink += downlink
 
     return list(usages.values())
 
@@ -1326,6 +1687,9 @@ def remove_node(db: Session, dbnode: Node) -> Node:
     Returns:
         Node: The removed Node object.
     """
+    # rollups aren't linked to the node, the main core uses node id 0
+    for model in (NodeUserUsageDaily, NodeUserUsageMonthly, NodeUsageDaily, NodeUsageMonthly):
+        db.query(model).filter(model.node_id == dbnode.id).delete(synchronize_session=False)
     db.delete(dbnode)
     db.commit()
     return dbnode
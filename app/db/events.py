@@ -0,0 +1,44 @@
+"""
+In-process signals fired by the crud layer when user rows change.
+
+In-memory structures (usage accumulator, caches, indexes) subscribe to these
+instead of re-reading the users table on every tick.
+"""
+
+from typing import Callable, List
+
+from app import logger
+
+
+class Signal:
+    def __init__(self, name: str):
+        self.name = name
+        self._receivers: List[Callable] = []
+
+    def connect(self, func: Callable):
+        self._receivers.append(func)
+        return func
+
+    def send(self, *args, **kwargs):
+        for func in self._receivers:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception(f"Receiver of \"{self.name}\" signal failed")
+
+
+# (dbuser) sent after a user is created or modified
+user_updated = Signal("user_updated")
+
+# (dbuser) sent after a user is deleted
+user_removed = Signal("user_removed")
+
+# () sent after bulk statements that modify many users at once
+users_updated = Signal("users_updated")
+
+# (user_ids, lifetime=False) sent after the used traffic of the users is reset, user_ids is None
+# for all users, lifetime tells whether their lifetime used traffic was reset too
+usage_reset = Signal("usage_reset")
+
+# (usages) sent with the user id -> traffic deltas recorded in each tick
+usage_recorded = Signal("usage_recorded")
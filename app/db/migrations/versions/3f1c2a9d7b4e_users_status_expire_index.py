@@ -0,0 +1,23 @@
+"""users status expire index
+
+Revision ID: 3f1c2a9d7b4e
+Revises: 2b231de97dc3
+Create Date: 2026-10-18 10:12:41.208317
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b4e'
+down_revision = '2b231de97dc3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_users_status_expire', 'users', ['status', 'expire'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_users_status_expire', table_name='users')
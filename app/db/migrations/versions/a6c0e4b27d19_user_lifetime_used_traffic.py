@@ -0,0 +1,54 @@
+"""user lifetime_used_traffic
+
+Revision ID: a6c0e4b27d19
+Revises: 3f1c2a9d7b4e
+Create Date: 2026-10-18 14:36:09.512804
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c0e4b27d19'
+down_revision = '3f1c2a9d7b4e'
+branch_labels = None
+depends_on = None
+
+users_table = sa.Table(
+    'users',
+    sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('used_traffic', sa.BigInteger),
+    sa.Column('lifetime_used_traffic', sa.BigInteger),
+)
+
+user_usage_logs_table = sa.Table(
+    'user_usage_logs',
+    sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('user_id', sa.Integer),
+    sa.Column('used_traffic_at_reset', sa.BigInteger),
+)
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('lifetime_used_traffic', sa.BigInteger(),
+                                     server_default='0', nullable=False))
+
+    # Backfill with the current usage plus the traffic of all resets
+    reseted_usage = (
+        sa.select(sa.func.coalesce(sa.func.sum(user_usage_logs_table.c.used_traffic_at_reset), 0))
+        .where(user_usage_logs_table.c.user_id == users_table.c.id)
+        .scalar_subquery()
+    )
+    connection = op.get_bind()
+    connection.execute(
+        sa.update(users_table)
+        .values(lifetime_used_traffic=sa.func.coalesce(users_table.c.used_traffic, 0) + reseted_usage)
+    )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('lifetime_used_traffic')
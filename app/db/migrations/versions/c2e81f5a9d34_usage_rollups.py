@@ -0,0 +1,90 @@
+"""usage rollups
+
+Revision ID: c2e81f5a9d34
+Revises: a6c0e4b27d19
+Create Date: 2026-10-18 16:05:47.318426
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2e81f5a9d34'
+down_revision = 'a6c0e4b27d19'
+branch_labels = None
+depends_on = None
+
+
+def _truncate(connection, column, period: str):
+    """Start of the day or month of a datetime column, in the format the dialect stores datetimes."""
+    if connection.engine.name == "sqlite":
+        fmt = '%Y-%m-%d 00:00:00.000000' if period == 'day' else '%Y-%m-01 00:00:00.000000'
+        return sa.func.strftime(fmt, column)
+    if connection.engine.name == "postgresql":
+        return sa.func.date_trunc(period, column)
+    # MySQL / MariaDB
+    if period == 'day':
+        return sa.func.date(column)
+    return sa.func.date_format(column, '%Y-%m-01')
+
+
+def upgrade() -> None:
+    for period in ('daily', 'monthly'):
+        op.create_table(
+            f'node_user_usages_{period}',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('node_id', sa.Integer(), nullable=False),
+            sa.Column('used_traffic', sa.BigInteger(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('created_at', 'user_id', 'node_id')
+        )
+        op.create_table(
+            f'node_usages_{period}',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('node_id', sa.Integer(), nullable=False),
+            sa.Column('uplink', sa.BigInteger(), nullable=True),
+            sa.Column('downlink', sa.BigInteger(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('created_at', 'node_id')
+        )
+
+    # Backfill the rollups from the hourly rows
+    connection = op.get_bind()
+    metadata = sa.MetaData()
+    node_user_usages = sa.Table('node_user_usages', metadata, autoload_with=connection)
+    node_usages = sa.Table('node_usages', metadata, autoload_with=connection)
+
+    for period, suffix in (('day', 'daily'), ('month', 'monthly')):
+        created_at = _truncate(connection, node_user_usages.c.created_at, period)
+        node_id = sa.func.coalesce(node_user_usages.c.node_id, 0)
+        connection.execute(
+            sa.insert(sa.Table(f'node_user_usages_{suffix}', metadata, autoload_with=connection)).from_select(
+                ['created_at', 'user_id', 'node_id', 'used_traffic'],
+                sa.select(created_at, node_user_usages.c.user_id, node_id,
+                          sa.func.sum(node_user_usages.c.used_traffic))
+                .where(node_user_usages.c.user_id.isnot(None))
+                .group_by(created_at, node_user_usages.c.user_id, node_id)
+            )
+        )
+
+        created_at = _truncate(connection, node_usages.c.created_at, period)
+        node_id = sa.func.coalesce(node_usages.c.node_id, 0)
+        connection.execute(
+            sa.insert(sa.Table(f'node_usages_{suffix}', metadata, autoload_with=connection)).from_select(
+                ['created_at', 'node_id', 'uplink', 'downlink'],
+                sa.select(created_at, node_id,
+                          sa.func.sum(node_usages.c.uplink), sa.func.sum(node_usages.c.downlink))
+                .group_by(created_at, node_id)
+            )
+        )
+
+
+def downgrade() -> None:
+    for period in ('daily', 'monthly'):
+        op.drop_table(f'node_usages_{period}')
+        op.drop_table(f'node_user_usages_{period}')
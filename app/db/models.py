@@ -10,15 +10,15 @@ from sqlalchemy import (
     Enum,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
     UniqueConstraint,
-    func,
 )
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql.expression import select, text
+from sqlalchemy.sql.expression import text
 
 from app import xray
 from app.db.base import Base
@@ -60,13 +60,20 @@ class AdminUsageLogs(Base):
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index('ix_users_status_expire', 'status', 'expire'),
+    )
 
     id = Column(Integer, primary_key=True)
     username = Column(String(34, collation='NOCASE'), unique=True, index=True)
     proxies = relationship("Proxy", back_populates="user", cascade="all, delete-orphan")
     status = Column(Enum(UserStatus), nullable=False, default=UserStatus.active)
     used_traffic = Column(BigInteger, default=0)
+    # used_traffic plus the traffic of all resets, kept up to date instead of summing usage_logs
+    lifetime_used_traffic = Column(BigInteger, default=0, server_default='0', nullable=False)
     node_usages = relationship("NodeUserUsage", back_populates="user", cascade="all, delete-orphan")
+    node_usages_daily = relationship("NodeUserUsageDaily", back_populates="user", cascade="all, delete-orphan")
+    node_usages_monthly = relationship("NodeUserUsageMonthly", back_populates="user", cascade="all, delete-orphan")
     notification_reminders = relationship("NotificationReminder", back_populates="user", cascade="all, delete-orphan")
     data_limit = Column(BigInteger, nullable=True)
     data_limit_reset_strategy = Column(
@@ -104,22 +111,11 @@ class User(Base):
 
     @hybrid_property
     def reseted_usage(self) -> int:
-        return int(sum([log.used_traffic_at_reset for log in self.usage_logs]))
+        return int((self.lifetime_used_traffic or 0) - (self.used_traffic or 0))
 
     @reseted_usage.expression
     def reseted_usage(cls):
-        return (
-            select(func.sum(UserUsageResetLogs.used_traffic_at_reset)).
-            where(UserUsageResetLogs.user_id == cls.id).
-            label('reseted_usage')
-        )
-
-    @property
-    def lifetime_used_traffic(self) -> int:
-        return int(
-            sum([log.used_traffic_at_reset for log in self.usage_logs])
-            + self.used_traffic
-        )
+        return (cls.lifetime_used_traffic - cls.used_traffic).label('reseted_usage')
 
     @property
     def last_traffic_reset_time(self):
@@ -340,6 +336,60 @@ class NodeUsage(Base):
     downlink = Column(BigInteger, default=0)
 
 
+class NodeUserUsageDaily(Base):
+    __tablename__ = "node_user_usages_daily"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'user_id', 'node_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one day per record
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user = relationship("User", back_populates="node_usages_daily")
+    node_id = Column(Integer, nullable=False, default=0)  # 0 is the main core, NULLs can't be upserted
+    used_traffic = Column(BigInteger, default=0)
+
+
+class NodeUserUsageMonthly(Base):
+    __tablename__ = "node_user_usages_monthly"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'user_id', 'node_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one month per record
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user = relationship("User", back_populates="node_usages_monthly")
+    node_id = Column(Integer, nullable=False, default=0)  # 0 is the main core, NULLs can't be upserted
+    used_traffic = Column(BigInteger, default=0)
+
+
+class NodeUsageDaily(Base):
+    __tablename__ = "node_usages_daily"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'node_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one day per record
+    node_id = Column(Integer, nullable=False, default=0)  # 0 is the main core, NULLs can't be upserted
+    uplink = Column(BigInteger, default=0)
+    downlink = Column(BigInteger, default=0)
+
+
+class NodeUsageMonthly(Base):
+    __tablename__ = "node_usages_monthly"
+    __table_args__ = (
+        UniqueConstraint('created_at', 'node_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, unique=False, nullable=False)  # one month per record
+    node_id = Column(Integer, nullable=False, default=0)  # 0 is the main core, NULLs can't be upserted
+    uplink = Column(BigInteger, default=0)
+    downlink = Column(BigInteger, default=0)
+
+
 class NotificationReminder(Base):
     __tablename__ = "notification_reminders"
 
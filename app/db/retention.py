@@ -0,0 +1,144 @@
+"""
+Retention of the usage rows: hourly rows older than USAGE_HOURLY_RETENTION_DAYS
+are compacted into daily rows, and daily rows older than
+USAGE_DAILY_RETENTION_MONTHS into monthly rows.
+
+Each period is compacted in chunks of users, one short transaction per chunk,
+which replaces the chunk's rollup rows of the period with the sum of the finer
+rows and deletes them.
+"""
+
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import DateTime, delete, func, insert, literal, select
+from sqlalchemy.orm import Session
+
+from app import logger
+from app.db import GetDB
+from app.db.usage import NODE_USAGE_TABLES, USER_USAGE_TABLES, safe_transaction, start_of_day, start_of_month
+from app.utils.metrics import metrics
+from config import USAGE_DAILY_RETENTION_MONTHS, USAGE_HOURLY_RETENTION_DAYS, USAGE_RETENTION_CHUNK_SIZE
+
+
+def _next_day(dt: datetime) -> datetime:
+    return dt + timedelta(days=1)
+
+
+def _next_month(dt: datetime) -> datetime:
+    return (dt + timedelta(days=32)).replace(day=1)
+
+
+class UsageRetention:
+    def __init__(self, hourly_days: int, daily_months: int, chunk_size: int):
+        self.hourly_days = hourly_days
+        self.daily_months = daily_months
+        self.chunk_size = chunk_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.hourly_days > 0 or self.daily_months > 0
+
+    def hourly_since(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Oldest day whose hourly rows are kept, None if they are kept forever."""
+        if self.hourly_days <= 0:
+            return None
+        return start_of_day((now or datetime.utcnow()) - timedelta(days=self.hourly_days))
+
+    def daily_since(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Oldest month whose daily rows are kept, None if they are kept forever."""
+        if self.daily_months <= 0:
+            return None
+        now = now or datetime.utcnow()
+        index = now.year * 12 + now.month - 1 - self.daily_months
+        since = start_of_month(now).replace(year=index // 12, month=index % 12 + 1)
+
+        hourly_since = self.hourly_since(now)
+        if hourly_since is not None:
+            # a month is compacted only after the hours of all its days are
+            since = min(since, start_of_month(hourly_since))
+        return since
+
+    def _compact(self, db: Session, source, target, before: datetime,
+                 period_of: Callable[[datetime], datetime], next_period: Callable[[datetime], datetime],
+                 columns: List[str]) -> int:
+        """Compacts the source rows older than before into one target row per period, returns the rows removed."""
+        by_user = hasattr(source, 'user_id')
+        node_id = func.coalesce(source.node_id, 0)
+        compacted = 0
+
+        while True:
+            oldest = db.query(func.min(source.created_at)).filter(source.created_at < before).scalar()
+            if oldest is None:
+                return compacted
+
+            period = period_of(oldest)
+            in_period = (source.created_at >= period) & (source.created_at < next_period(period))
+
+            if by_user:
+                user_ids = [row[0] for row in db.query(source.user_id).filter(in_period).distinct()]
+                chunks = [user_ids[i:i + self.chunk_size] for i in range(0, len(user_ids), self.chunk_size)]
+            else:
+                chunks = [None]
+
+            for chunk in chunks:
+                if chunk is None:
+                    cond, target_cond, keys = in_period, target.created_at == period, []
+                else:
+                    # rows left without a user can't be rolled up, they are only removed
+                    user_ids = [user_id for user_id in chunk if user_id is not None]
+                    in_chunk = source.user_id.in_(user_ids)
+                    if None in chunk:
+                        in_chunk = in_chunk | source.user_id.is_(None)
+                    cond = in_period & in_chunk
+                    target_cond = (target.created_at == period) & target.user_id.in_(user_ids)
+                    keys = [source.user_id]
+
+                rows = select(literal(period, DateTime()), *keys, node_id,
+                              *(func.sum(getattr(source, column)) for column in columns)) \
+                    .where((cond & source.user_id.isnot(None)) if keys else cond) \
+                    .group_by(*keys, node_id)
+                results = safe_transaction(db, [
+                    (delete(target).where(target_cond), None),
+                    (insert(target).from_select(
+                        ['created_at', *(['user_id'] if keys else []), 'node_id', *columns], rows), None),
+                    (delete(source).where(cond), None),
+                ])
+                compacted += results[-1].rowcount
+
+    def run(self) -> Dict[str, int]:
+        """
+        Compacts the usage rows older than the retention.
+
+        Returns:
+            Dict[str, int]: Number of hourly and daily rows compacted.
+        """
+        now = datetime.utcnow()
+        hourly_since, daily_since = self.hourly_since(now), self.daily_since(now)
+        compacted = {"hourly": 0, "daily": 0}
+
+        start_time = time.perf_counter()
+        with GetDB() as db:
+            if hourly_since is not None:
+                for tables, columns in ((USER_USAGE_TABLES, ['used_traffic']),
+                                        (NODE_USAGE_TABLES, ['uplink', 'downlink'])):
+                    compacted["hourly"] += self._compact(db, tables["hour"], tables["day"], hourly_since,
+                                                         start_of_day, _next_day, columns)
+            if daily_since is not None:
+                for tables, columns in ((USER_USAGE_TABLES, ['used_traffic']),
+                                        (NODE_USAGE_TABLES, ['uplink', 'downlink'])):
+                    compacted["daily"] += self._compact(db, tables["day"], tables["month"], daily_since,
+                                                        start_of_month, _next_month, columns)
+
+        elapsed = time.perf_counter() - start_time
+        metrics.inc("usage_retention_compacted_hourly_rows", compacted["hourly"])
+        metrics.inc("usage_retention_compacted_daily_rows", compacted["daily"])
+        metrics.set("usage_retention_last_run_seconds", elapsed)
+        logger.info(f"Compacted {compacted['hourly']} hourly and {compacted['daily']} daily usage rows "
+                    f"in {elapsed:.3f} seconds")
+
+        return compacted
+
+
+retention = UsageRetention(USAGE_HOURLY_RETENTION_DAYS, USAGE_DAILY_RETENTION_MONTHS, USAGE_RETENTION_CHUNK_SIZE)
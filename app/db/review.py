@@ -0,0 +1,242 @@
+"""
+Index of users which may change state, so the review job doesn't have to
+load every active and on-hold user on each tick.
+"""
+
+import heapq
+import math
+from datetime import datetime
+from threading import Lock
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.db import GetDB, events
+from app.db.models import User
+from app.db.usage import accumulator
+from app.models.user import UserStatus
+from config import NOTIFY_DAYS_LEFT, NOTIFY_REACHED_USAGE_PERCENT, WEBHOOK_ADDRESS
+
+
+def _query_rows(db: Session):
+    return db.query(User.id, User.status, User.used_traffic, User.data_limit, User.expire,
+                    User.on_hold_timeout, User.online_at, User.edit_at, User.created_at)
+
+
+class ReviewIndex:
+    """
+    Tracks when each active or on-hold user has to be reviewed next.
+
+    Time based thresholds (expiry, days-left reminders, on-hold timeout) are
+    kept in a min-heap, traffic based thresholds (data limit, usage percent
+    reminders) as the traffic left until the next one, which is decreased
+    by the usage accumulator. Users whose threshold is passed are moved to
+    the ready set and handed to the review job.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._heap: List[Tuple[float, int]] = []
+        self._due_at: Dict[int, float] = {}
+        self._traffic_left: Dict[int, int] = {}
+        self._on_hold: Set[int] = set()
+        self._ready: Set[int] = set()
+        self._traffic_ready = False
+        self._loaded = False
+
+    @staticmethod
+    def _traffic_thresholds(data_limit: int) -> List[int]:
+        thresholds = [data_limit]
+        if WEBHOOK_ADDRESS:
+            thresholds += [math.ceil(data_limit * percent / 100) for percent in NOTIFY_REACHED_USAGE_PERCENT]
+        return sorted(thresholds)
+
+    @staticmethod
+    def _time_thresholds(expire: int) -> List[float]:
+        thresholds = [expire]
+        if WEBHOOK_ADDRESS:
+            thresholds += [expire - (days + 1) * 86400 + 1 for days in NOTIFY_DAYS_LEFT]
+        return sorted(thresholds)
+
+    def _untrack(self, user_id: int):
+        self._due_at.pop(user_id, None)
+        self._traffic_left.pop(user_id, None)
+        self._on_hold.discard(user_id)
+        self._ready.discard(user_id)
+
+    def _track(self, user, reviewed: bool):
+        self._untrack(user.id)
+        if user.status not in (UserStatus.active, UserStatus.on_hold):
+            return
+
+        # same clock as the review job, timestamps are compared with it as is
+        now = datetime.utcnow().timestamp()
+        passed = False
+        pending_passed = False  # passed by traffic recorded after the review flushed the usages
+        due = None
+
+        if user.status == UserStatus.on_hold:
+            self._on_hold.add(user.id)
+            base_time = user.edit_at or user.created_at
+            if user.online_at and base_time and base_time <= user.online_at:
+                passed = True
+            elif accumulator.pending(user.id):
+                passed = pending_passed = True
+            if user.on_hold_timeout:
+                due = datetime.timestamp(user.on_hold_timeout)
+
+        else:
+            if user.data_limit:
+                pending = accumulator.pending(user.id)
+                used = (user.used_traffic or 0) + pending
+                for threshold in self._traffic_thresholds(user.data_limit):
+                    if used >= threshold:
+                        passed = True
+                        if threshold == user.data_limit and pending:
+                            pending_passed = True
+                    else:
+                        self._traffic_left[user.id] = threshold - used
+                        break
+
+            if user.expire:
+                for threshold in self._time_thresholds(user.expire):
+                    if threshold <= now:
+                        passed = True
+                    else:
+                        due = threshold
+                        break
+
+        if due is not None:
+            if due <= now:
+                passed = True
+            else:
+                self._due_at[user.id] = due
+                heapq.heappush(self._heap, (due, user.id))
+                if len(self._heap) > 2 * len(self._due_at) + 1024:
+                    # drop entries left behind by re-tracked users
+                    self._heap = [(due_at, user_id) for user_id, due_at in self._due_at.items()]
+                    heapq.heapify(self._heap)
+
+        if pending_passed:
+            # not seen by the review, the usage counted by add_usages was already spent
+            self._ready.add(user.id)
+            self._traffic_ready = True
+        elif passed and not reviewed:
+            self._ready.add(user.id)
+
+    def _rebuild(self):
+        self._heap = []
+        self._due_at = {}
+        self._traffic_left = {}
+        self._on_hold = set()
+        self._ready = set()
+
+        with GetDB() as db:
+            rows = _query_rows(db).filter(User.status.in_([UserStatus.active, UserStatus.on_hold])).all()
+
+        for row in rows:
+            self._track(row, reviewed=False)
+
+        # unflushed traffic of on-hold users isn't in online_at yet
+        self._traffic_ready = True
+        self._loaded = True
+
+    def track(self, user: User, reviewed: bool = False):
+        """
+        (Re)computes the next review of the user.
+
+        Args:
+            user (User): The user, or a row with the same columns.
+            reviewed (bool): Whether the user was just reviewed, passed thresholds are then ignored,
+                except the ones passed by traffic which isn't flushed yet.
+        """
+        with self._lock:
+            if self._loaded:
+                self._track(user, reviewed)
+
+    def mark_reviewed(self, db: Session, user_ids: List[int]):
+        """Re-tracks the users after a review which didn't change them."""
+        rows = _query_rows(db).filter(User.id.in_(user_ids)).all()
+        with self._lock:
+            if not self._loaded:
+                return
+            for user_id in user_ids:
+                self._untrack(user_id)
+            for row in rows:
+                self._track(row, reviewed=True)
+
+    def untrack(self, user_id: int):
+        with self._lock:
+            self._untrack(user_id)
+
+    def invalidate(self):
+        """Forces a rebuild from the database on the next pop."""
+        with self._lock:
+            self._loaded = False
+
+    def add_usages(self, usages: Dict[int, int]):
+        with self._lock:
+            if not self._loaded:
+                return
+            for user_id, value in usages.items():
+                if user_id in self._on_hold:
+                    self._on_hold.discard(user_id)
+                    self._ready.add(user_id)
+                    self._traffic_ready = True
+                    continue
+
+                left = self._traffic_left.get(user_id)
+                if left is None:
+                    continue
+                left -= value
+                if left > 0:
+                    self._traffic_left[user_id] = left
+                else:
+                    del self._traffic_left[user_id]
+                    self._ready.add(user_id)
+                    self._traffic_ready = True
+
+    def pop_due(self, now: float) -> Tuple[Set[int], bool]:
+        """
+        Takes the users which have to be reviewed.
+
+        Returns:
+            Tuple[Set[int], bool]: User IDs, and whether any of them was triggered by traffic
+            which may still be pending in the usage accumulator.
+        """
+        with self._lock:
+            if not self._loaded:
+                self._rebuild()
+
+            while self._heap and self._heap[0][0] <= now:
+                due, user_id = heapq.heappop(self._heap)
+                if self._due_at.get(user_id) == due:
+                    del self._due_at[user_id]
+                    self._ready.add(user_id)
+
+            ready, self._ready = self._ready, set()
+            traffic_ready, self._traffic_ready = self._traffic_ready, False
+            return ready, traffic_ready
+
+
+review_index = ReviewIndex()
+
+
+@events.user_updated.connect
+def _on_user_updated(dbuser: User):
+    review_index.track(dbuser)
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: User):
+    review_index.untrack(dbuser.id)
+
+
+@events.users_updated.connect
+def _on_users_updated():
+    review_index.invalidate()
+
+
+@events.usage_recorded.connect
+def _on_usage_recorded(usages: Dict[int, int]):
+    review_index.add_usages(usages)
@@ -0,0 +1,113 @@
+"""
+Buffered writes of the users' last subscription update, so polling a
+subscription doesn't commit a transaction per request.
+"""
+
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, Tuple
+
+from sqlalchemy import bindparam, update
+
+from app import logger
+from app.db import GetDB, events
+from app.db.models import User
+from app.db.usage import safe_execute
+from app.utils.metrics import metrics
+from config import SUB_UPDATED_AT_MIN_INTERVAL
+
+
+class SubUpdateBuffer:
+    """
+    Keeps the last subscription update (time, user agent) of each user in
+    memory until the next flush, later updates of a user replace earlier ones.
+    """
+
+    def __init__(self, min_interval: int):
+        self.min_interval = timedelta(seconds=min_interval)
+        self._lock = Lock()
+        self._pending: Dict[int, Tuple[datetime, str]] = {}
+
+    def record(self, dbuser: User, user_agent: str) -> bool:
+        """
+        Records a subscription update of the user.
+
+        The update is skipped when the user agent is unchanged and the last
+        update is more recent than SUB_UPDATED_AT_MIN_INTERVAL.
+
+        Args:
+            dbuser (User): The user.
+            user_agent (str): User agent of the client.
+
+        Returns:
+            bool: Whether the update was buffered.
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            updated_at, last_user_agent = self._pending.get(
+                dbuser.id, (dbuser.sub_updated_at, dbuser.sub_last_user_agent)
+            )
+            if last_user_agent == user_agent and updated_at and now - updated_at < self.min_interval:
+                metrics.inc("sub_updates_skipped")
+                return False
+
+            self._pending[dbuser.id] = (now, user_agent)
+            return True
+
+    def discard(self, user_id: int):
+        with self._lock:
+            self._pending.pop(user_id, None)
+
+    def _restore(self, rows: list):
+        with self._lock:
+            for row in rows:
+                # a newer update recorded during the flush wins
+                self._pending.setdefault(row['uid'], (row['updated_at'], row['user_agent']))
+
+    def flush(self) -> int:
+        """
+        Writes the buffered updates to the database.
+
+        Returns:
+            int: Number of user rows updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        rows = [
+            {"uid": user_id, "updated_at": updated_at, "user_agent": user_agent}
+            for user_id, (updated_at, user_agent) in pending.items()
+        ]
+
+        start_time = time.perf_counter()
+        with GetDB() as db:
+            stmt = update(User). \
+                where(User.id == bindparam('uid')). \
+                values(
+                    sub_updated_at=bindparam('updated_at'),
+                    sub_last_user_agent=bindparam('user_agent')
+            )
+            try:
+                safe_execute(db, stmt, rows)
+            except Exception:
+                self._restore(rows)
+                metrics.inc("sub_updates_flush_failures")
+                raise
+
+        elapsed = time.perf_counter() - start_time
+        metrics.inc("sub_updates_flushed_rows", len(rows))
+        logger.debug(f"Flushed subscription updates of {len(rows)} users in {elapsed:.3f} seconds")
+
+        return len(rows)
+
+
+sub_updates = SubUpdateBuffer(SUB_UPDATED_AT_MIN_INTERVAL)
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: User):
+    sub_updates.discard(dbuser.id)
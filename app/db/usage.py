@@ -0,0 +1,479 @@
+"""
+Writing of traffic usage to the database: in-memory accumulation of users'
+traffic between flushes, dialect-aware batched upserts and the daily and
+monthly rollups of the hourly usage rows.
+"""
+
+import random
+import time
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Table, and_, bindparam, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+
+from app import logger
+from app.db import GetDB, events
+from app.db.models import (
+    Admin,
+    NodeUsage,
+    NodeUsageDaily,
+    NodeUsageMonthly,
+    NodeUserUsage,
+    NodeUserUsageDaily,
+    NodeUserUsageMonthly,
+    User,
+)
+from app.utils.metrics import metrics
+
+
+SAFE_EXECUTE_RETRIES = 3
+UPSERT_CHUNK_SIZE = 1000
+SQLITE_UPSERT_CHUNK_SIZE = 200  # keeps statements under old sqlite bound parameters limit
+
+
+def _is_retryable(err: OperationalError) -> bool:
+    orig = getattr(err, 'orig', None)
+    if orig is None:
+        return False
+    if getattr(orig, 'pgcode', None) == '40P01':  # PostgreSQL deadlock
+        return True
+    if orig.args and orig.args[0] == 1213:  # MySQL / MariaDB deadlock
+        return True
+    return 'database is locked' in str(orig)  # SQLite
+
+
+def safe_transaction(db: Session, statements: List[Tuple]) -> list:
+    """
+    Executes (statement, params) pairs in one transaction and commits them,
+    retrying with jittered backoff when the database reports a deadlock.
+
+    Returns:
+        list: Result of each statement.
+    """
+    tries = 0
+    while True:
+        try:
+            connection = db.connection()
+            results = [connection.execute(stmt, params) for stmt, params in statements]
+            db.commit()
+            return results
+        except OperationalError as err:
+            db.rollback()
+            if tries >= SAFE_EXECUTE_RETRIES or not _is_retryable(err):
+                raise err
+            tries += 1
+            metrics.inc("db_deadlock_retries")
+            time.sleep(random.uniform(0, 0.05 * 2 ** tries))
+
+
+def safe_execute(db: Session, stmt, params=None):
+    """
+    Executes and commits a statement, retrying with jittered backoff
+    when the database reports a deadlock.
+    """
+    safe_transaction(db, [(stmt, params)])
+
+
+def _upsert_stmt(db: Session, table: Table, rows: List[dict], index_elements: List[str], increments: List[str]):
+    dialect = db.bind.dialect.name
+
+    if dialect in ('mysql', 'mariadb'):
+        stmt = mysql_insert(table).values(rows)
+        return stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in increments})
+
+    if dialect == 'postgresql':
+        stmt = postgresql_insert(table).values(rows)
+    elif dialect == 'sqlite':
+        stmt = sqlite_insert(table).values(rows)
+    else:
+        raise NotImplementedError(f"Upsert is not supported on {dialect}")
+
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={c: table.c[c] + stmt.excluded[c] for c in increments}
+    )
+
+
+def upsert(db: Session, table: Table, rows: List[dict], index_elements: List[str], increments: List[str]):
+    """
+    Inserts rows or adds their ``increments`` columns to the existing rows
+    matching ``index_elements``, one statement per chunk.
+
+    ``index_elements`` must be covered by a unique constraint and must not be
+    NULL, NULLs never conflict with each other.
+    """
+    chunk_size = SQLITE_UPSERT_CHUNK_SIZE if db.bind.dialect.name == 'sqlite' else UPSERT_CHUNK_SIZE
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        try:
+            safe_execute(db, _upsert_stmt(db, table, chunk, index_elements, increments))
+        except IntegrityError:
+            # a user or node was removed after its traffic was collected,
+            # upsert the rows one by one so only the rows referencing it are lost
+            db.rollback()
+            skipped = 0
+            for row in chunk:
+                try:
+                    safe_execute(db, _upsert_stmt(db, table, [row], index_elements, increments))
+                except IntegrityError:
+                    db.rollback()
+                    skipped += 1
+            metrics.inc("db_upsert_skipped_rows", skipped)
+            logger.warning(f"Skipped {skipped} usage rows of removed users or nodes in {table.name}")
+        metrics.inc("db_upserted_rows", len(chunk))
+
+
+def _add_master_user_usages(db: Session, created_at: datetime, usages: Dict[int, int]):
+    # node_id is NULL for the main core, so these rows can't rely on the unique constraint
+    select_stmt = select(NodeUserUsage.user_id) \
+        .where(and_(NodeUserUsage.node_id.is_(None), NodeUserUsage.created_at == created_at))
+    existings = {r[0] for r in db.execute(select_stmt).fetchall()}
+
+    uids_to_insert = [uid for uid in usages if uid not in existings]
+    if uids_to_insert:
+        stmt = insert(NodeUserUsage).values(
+            user_id=bindparam('uid'),
+            created_at=created_at,
+            node_id=None,
+            used_traffic=0
+        ).prefix_with('IGNORE', dialect='mysql')
+        safe_execute(db, stmt, [{'uid': uid} for uid in uids_to_insert])
+
+    stmt = update(NodeUserUsage) \
+        .values(used_traffic=NodeUserUsage.used_traffic + bindparam('value')) \
+        .where(and_(NodeUserUsage.user_id == bindparam('uid'),
+                    NodeUserUsage.node_id.is_(None),
+                    NodeUserUsage.created_at == created_at))
+    safe_execute(db, stmt, [{'uid': uid, 'value': value} for uid, value in usages.items()])
+
+
+def start_of_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def start_of_month(dt: datetime) -> datetime:
+    return start_of_day(dt).replace(day=1)
+
+
+def _ceil_day(dt: datetime) -> datetime:
+    day = start_of_day(dt)
+    return day if day == dt else day + timedelta(days=1)
+
+
+def _ceil_month(dt: datetime) -> datetime:
+    month = start_of_month(dt)
+    return month if month == dt else (month + timedelta(days=32)).replace(day=1)
+
+
+# usage tables of users and nodes per resolution
+USER_USAGE_TABLES = {"hour": NodeUserUsage, "day": NodeUserUsageDaily, "month": NodeUserUsageMonthly}
+NODE_USAGE_TABLES = {"hour": NodeUsage, "day": NodeUsageDaily, "month": NodeUsageMonthly}
+
+
+def usage_ranges(start: datetime, end: datetime,
+                 hourly_since: Optional[datetime] = None,
+                 daily_since: Optional[datetime] = None) -> List[Tuple[str, datetime, datetime]]:
+    """
+    Splits the hours between start and end (inclusive) into ranges of whole
+    months, whole days and the remaining hours, so they can be read from the
+    coarsest usage table covering them.
+
+    Args:
+        start (datetime): Start of the period.
+        end (datetime): End of the period.
+        hourly_since (Optional[datetime]): Oldest day whose hourly rows are kept, the hours
+            before it are rounded out to whole days.
+        daily_since (Optional[datetime]): Oldest month whose daily rows are kept, the days
+            before it are rounded out to whole months.
+
+    Returns:
+        List[Tuple[str, datetime, datetime]]: (resolution, start, exclusive end) of each range.
+    """
+    first_hour = start.replace(minute=0, second=0, microsecond=0)
+    if first_hour < start:
+        first_hour += timedelta(hours=1)
+    end = end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    if first_hour >= end:
+        return []
+
+    if hourly_since is not None:
+        hourly_since = hourly_since.replace(tzinfo=start.tzinfo)
+        if first_hour < hourly_since:
+            first_hour = start_of_day(first_hour)
+        if start_of_day(end) < hourly_since:
+            end = _ceil_day(end)
+    if daily_since is not None:
+        daily_since = daily_since.replace(tzinfo=start.tzinfo)
+        if first_hour < daily_since:
+            first_hour = start_of_month(first_hour)
+        if start_of_month(end) < daily_since:
+            end = _ceil_month(end)
+
+    first_day, last_day = _ceil_day(first_hour), start_of_day(end)
+    if first_day >= last_day:
+        return [("hour", first_hour, end)]
+
+    first_month, last_month = _ceil_month(first_day), start_of_month(last_day)
+    ranges = [("hour", first_hour, first_day), ("hour", last_day, end)]
+    if first_month >= last_month:
+        ranges.append(("day", first_day, last_day))
+    else:
+        ranges += [("day", first_day, first_month), ("day", last_month, last_day),
+                   ("month", first_month, last_month)]
+    return [r for r in ranges if r[1] < r[2]]
+
+
+def add_node_user_usages(db: Session, created_at: datetime, usages: Dict[Optional[int], Dict[int, int]]):
+    """
+    Adds users' traffic to the hourly, daily and monthly usage rows of every node.
+
+    Args:
+        db (Session): Database session.
+        created_at (datetime): The hour the traffic belongs to.
+        usages (Dict[Optional[int], Dict[int, int]]): node id (None for the main core) -> user id -> traffic.
+    """
+    # users removed since their traffic was collected would fail the whole chunk
+    user_ids = list({uid for node_usages in usages.values() for uid in node_usages})
+    existing = set()
+    for i in range(0, len(user_ids), SQLITE_UPSERT_CHUNK_SIZE):
+        existing.update(r[0] for r in db.query(User.id).filter(User.id.in_(user_ids[i:i + SQLITE_UPSERT_CHUNK_SIZE])))
+    if len(existing) < len(user_ids):
+        usages = {node_id: {uid: value for uid, value in node_usages.items() if uid in existing}
+                  for node_id, node_usages in usages.items()}
+
+    rows = [
+        {"created_at": created_at, "user_id": uid, "node_id": node_id, "used_traffic": value}
+        for node_id, node_usages in usages.items() if node_id is not None
+        for uid, value in node_usages.items()
+    ]
+    if rows:
+        upsert(db, NodeUserUsage.__table__, rows,
+               index_elements=['created_at', 'user_id', 'node_id'],
+               increments=['used_traffic'])
+
+    if usages.get(None):
+        _add_master_user_usages(db, created_at, usages[None])
+
+    for model, period_start in ((NodeUserUsageDaily, start_of_day(created_at)),
+                                (NodeUserUsageMonthly, start_of_month(created_at))):
+        rows = [
+            {"created_at": period_start, "user_id": uid, "node_id": node_id or 0, "used_traffic": value}
+            for node_id, node_usages in usages.items()
+            for uid, value in node_usages.items()
+        ]
+        if not rows:
+            continue
+        upsert(db, model.__table__, rows,
+               index_elements=['created_at', 'user_id', 'node_id'],
+               increments=['used_traffic'])
+
+
+def add_node_usage_rollups(db: Session, created_at: datetime, node_id: Optional[int], uplink: int, downlink: int):
+    """
+    Adds a node's traffic to its daily and monthly usage rows.
+
+    Args:
+        db (Session): Database session.
+        created_at (datetime): The hour the traffic belongs to.
+        node_id (Optional[int]): The node id, None for the main core.
+        uplink (int): Uploaded traffic.
+        downlink (int): Downloaded traffic.
+    """
+    for model, period_start in ((NodeUsageDaily, start_of_day(created_at)),
+                                (NodeUsageMonthly, start_of_month(created_at))):
+        upsert(db, model.__table__,
+               [{"created_at": period_start, "node_id": node_id or 0, "uplink": uplink, "downlink": downlink}],
+               index_elements=['created_at', 'node_id'],
+               increments=['uplink', 'downlink'])
+
+
+class UsageAccumulator:
+    """
+    Keeps per-user traffic deltas in memory and writes them to the database
+    in batches, along with the usage of the users' admins.
+
+    User ids are dense integers, so pending deltas and last-seen timestamps
+    are stored in flat arrays indexed by user id. The admins of the users are
+    read when flushing, since they can be changed by other processes (e.g. the CLI).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # traffic to add to used_traffic, lifetime_used_traffic and the admin's users_usage,
+        # they differ once the usage of a user is reset
+        self._used = array('q')
+        self._lifetime = array('q')
+        self._admin = array('q')
+        self._online = array('q')
+        self._dirty = set()
+        self._admin_usage: Dict[int, int] = defaultdict(int)  # traffic of removed users
+
+    def _grow(self, user_id: int):
+        size = len(self._used)
+        if user_id < size:
+            return
+        extra = max(user_id + 1, size + size // 2) - size
+        for arr in (self._used, self._lifetime, self._admin, self._online):
+            arr.frombytes(bytes(arr.itemsize * extra))
+
+    def discard(self, user_id: int, admin_id: Optional[int] = None):
+        """Drops the pending traffic of a removed user, it's still added to the usage of its admin."""
+        with self._lock:
+            if user_id < len(self._used):
+                if admin_id and self._admin[user_id]:
+                    self._admin_usage[admin_id] += self._admin[user_id]
+                for arr in (self._used, self._lifetime, self._admin):
+                    arr[user_id] = 0
+            self._dirty.discard(user_id)
+
+    def reset(self, user_ids: Optional[List[int]] = None, lifetime: bool = False):
+        """
+        Drops the pending traffic of the users (of all users if None) from
+        their used traffic once it was reset, and from their lifetime used
+        traffic if that was reset too. It's still added to their admins' usage.
+        """
+        with self._lock:
+            if user_ids is None:
+                user_ids = list(self._dirty)
+            for user_id in user_ids:
+                if user_id < len(self._used):
+                    self._used[user_id] = 0
+                    if lifetime:
+                        self._lifetime[user_id] = 0
+
+    def pending(self, user_id: int) -> int:
+        """Traffic recorded for the user which isn't flushed yet."""
+        with self._lock:
+            if user_id < len(self._used):
+                return self._used[user_id]
+            return 0
+
+    def record(self, usages: Dict[int, int]):
+        """
+        Adds traffic deltas (user id -> bytes) seen in the current tick.
+        """
+        if not usages:
+            return
+
+        now = int(time.time())
+        with self._lock:
+            for user_id, value in usages.items():
+                self._grow(user_id)
+                self._used[user_id] += value
+                self._lifetime[user_id] += value
+                self._admin[user_id] += value
+                self._online[user_id] = now
+                self._dirty.add(user_id)
+
+        events.usage_recorded.send(usages)
+
+    def _restore(self, users_usage: list, admin_usage: Dict[int, int]):
+        with self._lock:
+            for row in users_usage:
+                self._grow(row['uid'])
+                self._used[row['uid']] += row['value']
+                self._lifetime[row['uid']] += row['lifetime']
+                self._admin[row['uid']] += row['admin']
+                self._dirty.add(row['uid'])
+            for admin_id, value in admin_usage.items():
+                self._admin_usage[admin_id] += value
+
+    @staticmethod
+    def _get_admin_ids(db: Session, user_ids: List[int]) -> Dict[int, int]:
+        admin_ids = {}
+        for i in range(0, len(user_ids), SQLITE_UPSERT_CHUNK_SIZE):
+            query = db.query(User.id, User.admin_id) \
+                .filter(User.id.in_(user_ids[i:i + SQLITE_UPSERT_CHUNK_SIZE]), User.admin_id.isnot(None))
+            admin_ids.update(query.all())
+        return admin_ids
+
+    def flush(self) -> int:
+        """
+        Writes pending deltas to the database.
+
+        Returns:
+            int: Number of user rows updated.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            users_usage = []
+            for user_id in dirty:
+                users_usage.append({
+                    "uid": user_id,
+                    "value": self._used[user_id],
+                    "lifetime": self._lifetime[user_id],
+                    "admin": self._admin[user_id],
+                    "online_at": datetime.utcfromtimestamp(self._online[user_id]),
+                })
+                self._used[user_id] = self._lifetime[user_id] = self._admin[user_id] = 0
+
+            admin_usage, self._admin_usage = self._admin_usage, defaultdict(int)
+
+        if not (users_usage or admin_usage):
+            return 0
+
+        start_time = time.perf_counter()
+        with GetDB() as db:
+            if users_usage:
+                stmt = update(User). \
+                    where(User.id == bindparam('uid')). \
+                    values(
+                        used_traffic=User.used_traffic + bindparam('value'),
+                        lifetime_used_traffic=User.lifetime_used_traffic + bindparam('lifetime'),
+                        online_at=bindparam('online_at')
+                )
+                try:
+                    admin_ids = self._get_admin_ids(db, [row['uid'] for row in users_usage])
+                    safe_execute(db, stmt, users_usage)
+                except Exception:
+                    self._restore(users_usage, admin_usage)
+                    metrics.inc("usage_flush_failures")
+                    raise
+
+                for row in users_usage:
+                    admin_id = admin_ids.get(row['uid'])
+                    if admin_id and row['admin']:
+                        admin_usage[admin_id] += row['admin']
+
+            admin_rows = [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items() if value]
+            if admin_rows:
+                stmt = update(Admin). \
+                    where(Admin.id == bindparam('admin_id')). \
+                    values(users_usage=Admin.users_usage + bindparam('value'))
+                try:
+                    safe_execute(db, stmt, admin_rows)
+                except Exception:
+                    self._restore([], admin_usage)
+                    metrics.inc("usage_flush_failures")
+                    raise
+
+        elapsed = time.perf_counter() - start_time
+        metrics.inc("usage_flushes")
+        metrics.inc("usage_flushed_user_rows", len(users_usage))
+        metrics.inc("usage_flushed_admin_rows", len(admin_rows))
+        metrics.set("usage_last_flush_seconds", elapsed)
+        logger.debug(f"Flushed usage of {len(users_usage)} users and {len(admin_rows)} admins "
+                     f"in {elapsed:.3f} seconds")
+
+        return len(users_usage)
+
+
+accumulator = UsageAccumulator()
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: User):
+    accumulator.discard(dbuser.id, dbuser.admin_id)
+
+
+@events.usage_reset.connect
+def _on_usage_reset(user_ids: Optional[List[int]], lifetime: bool = False):
+    accumulator.reset(user_ids, lifetime)
@@ -1,10 +1,11 @@
 from typing import Optional, Union
 from app.models.admin import AdminInDB, AdminValidationResult, Admin
 from app.models.user import UserResponse, UserStatus
-from app.db import Session, crud, get_db
+from app.db import Session, User, crud, get_db
 from config import SUDOERS
 from fastapi import Depends, HTTPException
 from datetime import datetime, timezone, timedelta
+from app.subscription.auth import auth_cache
 from app.utils.jwt import get_subscription_payload
 
 
@@ -72,11 +73,13 @@ def get_validated_sub(
     if not sub:
         raise HTTPException(status_code=404, detail="Not Found")
 
-    dbuser = crud.get_user(db, sub['username'])
-    if not dbuser or dbuser.created_at > sub['created_at']:
+    auth = auth_cache.get(db, sub.username)
+    if not auth or not auth.accepts(sub.created_at):
         raise HTTPException(status_code=404, detail="Not Found")
 
-    if dbuser.sub_revoked_at and dbuser.sub_revoked_at > sub['created_at']:
+    # by primary key, the admin and the next plan are loaded only if used
+    dbuser = db.get(User, auth.id)
+    if not dbuser:
         raise HTTPException(status_code=404, detail="Not Found")
 
     return dbuser
@@ -18,20 +18,26 @@ def core_health_check():
         xray.core.restart(config)
 
     # nodes' core
+    to_restart, to_connect = [], []
     for node_id, node in list(xray.nodes.items()):
         if node.connected:
             try:
                 assert node.started
                 node.api.get_sys_stats(timeout=2)
             except (ConnectionError, xray_exc.XrayError, AssertionError):
-                if not config:
-                    config = xray.config.include_db_users()
-                xray.operations.restart_node(node_id, config)
+                to_restart.append(node_id)
 
         if not node.connected:
-            if not config:
-                config = xray.config.include_db_users()
-            xray.operations.connect_node(node_id, config)
+            to_connect.append(node_id)
+
+    if to_restart or to_connect:
+        if not config:
+            config = xray.config.include_db_users()
+        xray.operations.restart_nodes(to_restart, config)
+        xray.operations.connect_nodes(to_connect, config)
+
+    # cores which were unreachable but didn't need a restart
+    xray.reconciler.reconcile_stale(config, skip=to_restart + to_connect)
 
 
 @app.on_event("startup")
@@ -57,8 +63,7 @@ def start_core():
         for dbnode in dbnodes:
             crud.update_node_status(db, dbnode, NodeStatus.connecting)
 
-    for node_id in node_ids:
-        xray.operations.connect_node(node_id, config)
+    xray.operations.connect_nodes(node_ids, config)
 
     scheduler.add_job(core_health_check, 'interval',
                       seconds=JOB_CORE_HEALTH_CHECK_INTERVAL,
@@ -0,0 +1,13 @@
+from app import scheduler
+from app.db.retention import retention
+from config import JOB_COMPACT_USAGES_INTERVAL
+
+
+def compact_usages():
+    retention.run()
+
+
+if retention.enabled:
+    scheduler.add_job(compact_usages, 'interval',
+                      seconds=JOB_COMPACT_USAGES_INTERVAL,
+                      coalesce=True, max_instances=1)
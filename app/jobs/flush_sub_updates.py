@@ -0,0 +1,17 @@
+from app import app, scheduler
+from app.db.sub_updates import sub_updates
+from config import JOB_FLUSH_SUB_UPDATES_INTERVAL
+
+
+def flush_sub_updates():
+    sub_updates.flush()
+
+
+scheduler.add_job(flush_sub_updates, 'interval',
+                  seconds=JOB_FLUSH_SUB_UPDATES_INTERVAL,
+                  coalesce=True, max_instances=1)
+
+
+@app.on_event("shutdown")
+def app_shutdown():
+    flush_sub_updates()
@@ -0,0 +1,13 @@
+from app import scheduler
+from app.subscription.prerender import prerenderer
+from config import JOB_PRERENDER_SUBSCRIPTIONS_INTERVAL
+
+
+def prerender_subscriptions():
+    if prerenderer.changed():
+        prerenderer.run()
+
+
+scheduler.add_job(prerender_subscriptions, 'interval',
+                  seconds=JOB_PRERENDER_SUBSCRIPTIONS_INTERVAL,
+                  coalesce=True, max_instances=1)
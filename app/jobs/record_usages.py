@@ -4,16 +4,15 @@ from datetime import datetime
 from operator import attrgetter
 from typing import Union
 
-from pymysql.err import OperationalError
 from sqlalchemy import and_, bindparam, insert, select, update
-from sqlalchemy.orm import Session
-from sqlalchemy.sql.dml import Insert
 
-from app import scheduler, xray
+from app import app, scheduler, xray
 from app.db import GetDB
-from app.db.models import Admin, NodeUsage, NodeUserUsage, System, User
+from app.db.models import NodeUsage, System
+from app.db.usage import accumulator, add_node_usage_rollups, add_node_user_usages, safe_execute
 from config import (
     DISABLE_RECORDING_NODE_USAGE,
+    JOB_FLUSH_USER_USAGES_INTERVAL,
     JOB_RECORD_NODE_USAGES_INTERVAL,
     JOB_RECORD_USER_USAGES_INTERVAL,
 )
@@ -21,66 +20,23 @@ from xray_api import XRay as XRayAPI
 from xray_api import exc as xray_exc
 
 
-def safe_execute(db: Session, stmt, params=None):
-    if db.bind.name == 'mysql':
-        if isinstance(stmt, Insert):
-            stmt = stmt.prefix_with('IGNORE')
-
-        tries = 0
-        done = False
-        while not done:
-            try:
-                db.connection().execute(stmt, params)
-                db.commit()
-                done = True
-            except OperationalError as err:
-                if err.args[0] == 1213 and tries < 3:  # Deadlock
-                    db.rollback()
-                    tries += 1
-                    continue
-                raise err
-
-    else:
-        db.connection().execute(stmt, params)
-        db.commit()
-
-
-def record_user_stats(params: list, node_id: Union[int, None],
-                      consumption_factor: int = 1):
-    if not params:
-        return
-
+def record_user_stats(api_params: dict, usage_coefficient: dict):
     created_at = datetime.fromisoformat(datetime.utcnow().strftime('%Y-%m-%dT%H:00:00'))
 
-    with GetDB() as db:
-        # make user usage row if doesn't exist
-        select_stmt = select(NodeUserUsage.user_id) \
-            .where(and_(NodeUserUsage.node_id == node_id, NodeUserUsage.created_at == created_at))
-        existings = [r[0] for r in db.execute(select_stmt).fetchall()]
-        uids_to_insert = set()
-
-        for p in params:
-            uid = int(p['uid'])
-            if uid in existings:
-                continue
-            uids_to_insert.add(uid)
-
-        if uids_to_insert:
-            stmt = insert(NodeUserUsage).values(
-                user_id=bindparam('uid'),
-                created_at=created_at,
-                node_id=node_id,
-                used_traffic=0
-            )
-            safe_execute(db, stmt, [{'uid': uid} for uid in uids_to_insert])
+    usages = {}
+    for node_id, params in api_params.items():
+        coefficient = usage_coefficient.get(node_id, 1)
+        node_usages = defaultdict(int)
+        for param in params:
+            node_usages[int(param['uid'])] += int(param['value'] * coefficient)
+        if node_usages:
+            usages[node_id] = node_usages
 
-        # record
-        stmt = update(NodeUserUsage) \
-            .values(used_traffic=NodeUserUsage.used_traffic + bindparam('value') * consumption_factor) \
-            .where(and_(NodeUserUsage.user_id == bindparam('uid'),
-                        NodeUserUsage.node_id == node_id,
-                        NodeUserUsage.created_at == created_at))
-        safe_execute(db, stmt, params)
+    if not usages:
+        return
+
+    with GetDB() as db:
+        add_node_user_usages(db, created_at, usages)
 
 
 def record_node_stats(params: dict, node_id: Union[int, None]):
@@ -96,7 +52,8 @@ def record_node_stats(params: dict, node_id: Union[int, None]):
             where(and_(NodeUsage.node_id == node_id, NodeUsage.created_at == created_at))
         notfound = db.execute(select_stmt).first() is None
         if notfound:
-            stmt = insert(NodeUsage).values(created_at=created_at, node_id=node_id, uplink=0, downlink=0)
+            stmt = insert(NodeUsage).values(created_at=created_at, node_id=node_id, uplink=0, downlink=0) \
+                .prefix_with('IGNORE', dialect='mysql')
             safe_execute(db, stmt)
 
         # record
@@ -106,6 +63,10 @@ def record_node_stats(params: dict, node_id: Union[int, None]):
 
         safe_execute(db, stmt, params)
 
+        add_node_usage_rollups(db, created_at, node_id,
+                               uplink=sum(p['up'] for p in params),
+                               downlink=sum(p['down'] for p in params))
+
 
 def get_users_stats(api: XRayAPI):
     try:
@@ -144,43 +105,21 @@ def record_user_usages():
     for node_id, params in api_params.items():
         coefficient = usage_coefficient.get(node_id, 1)  # get the usage coefficient for the node
         for param in params:
-            users_usage[param['uid']] += int(param['value'] * coefficient)  # apply the usage coefficient
-    users_usage = list({"uid": uid, "value": value} for uid, value in users_usage.items())
+            users_usage[int(param['uid'])] += int(param['value'] * coefficient)  # apply the usage coefficient
     if not users_usage:
         return
 
-    with GetDB() as db:
-        user_admin_map = dict(db.query(User.id, User.admin_id).all())
-
-    admin_usage = defaultdict(int)
-    for user_usage in users_usage:
-        admin_id = user_admin_map.get(int(user_usage["uid"]))
-        if admin_id:
-            admin_usage[admin_id] += user_usage["value"]
-
-    # record users usage
-    with GetDB() as db:
-        stmt = update(User). \
-            where(User.id == bindparam('uid')). \
-            values(
-                used_traffic=User.used_traffic + bindparam('value'),
-                online_at=datetime.utcnow()
-        )
-
-        safe_execute(db, stmt, users_usage)
-
-        admin_data = [{"admin_id": admin_id, "value": value} for admin_id, value in admin_usage.items()]
-        if admin_data:
-            admin_update_stmt = update(Admin). \
-                where(Admin.id == bindparam('admin_id')). \
-                values(users_usage=Admin.users_usage + bindparam('value'))
-            safe_execute(db, admin_update_stmt, admin_data)
+    # users and admins usage is written to the database by flush_user_usages
+    accumulator.record(users_usage)
 
     if DISABLE_RECORDING_NODE_USAGE:
         return
 
-    for node_id, params in api_params.items():
-        record_user_stats(params, node_id, usage_coefficient[node_id])
+    record_user_stats(api_params, usage_coefficient)
+
+
+def flush_user_usages():
+    accumulator.flush()
 
 
 def record_node_usages():
@@ -220,6 +159,14 @@ def record_node_usages():
 scheduler.add_job(record_user_usages, 'interval',
                   seconds=JOB_RECORD_USER_USAGES_INTERVAL,
                   coalesce=True, max_instances=1)
+scheduler.add_job(flush_user_usages, 'interval',
+                  seconds=JOB_FLUSH_USER_USAGES_INTERVAL,
+                  coalesce=True, max_instances=1)
 scheduler.add_job(record_node_usages, 'interval',
                   seconds=JOB_RECORD_NODE_USAGES_INTERVAL,
                   coalesce=True, max_instances=1)
+
+
+@app.on_event("shutdown")
+def app_shutdown():
+    flush_user_usages()
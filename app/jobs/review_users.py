@@ -1,11 +1,13 @@
 from datetime import datetime
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 from sqlalchemy.orm import Session
 
 from app import logger, scheduler, xray
-from app.db import (GetDB, get_notification_reminder, get_users,
-                    start_user_expire, update_user_status, reset_user_by_next)
+from app.db import (GetDB, crud, get_notification_reminder, get_users,
+                    update_user_status, reset_user_by_next)
+from app.db.review import review_index
+from app.db.usage import accumulator
 from app.models.user import ReminderType, UserResponse, UserStatus
 from app.utils import report
 from app.utils.helpers import (calculate_expiration_days,
@@ -51,68 +53,80 @@ def reset_user_by_next_report(db: Session, user: "User"):
     report.user_data_reset_by_next(user=UserResponse.model_validate(user), user_admin=user.admin)
 
 
-def review():
-    now = datetime.utcnow()
-    now_ts = now.timestamp()
-    with GetDB() as db:
-        for user in get_users(db, status=UserStatus.active):
+REVIEW_CHUNK_SIZE = 500
 
-            limited = user.data_limit and user.used_traffic >= user.data_limit
-            expired = user.expire and user.expire <= now_ts
 
-            if (limited or expired) and user.next_plan is not None:
-                if user.next_plan is not None:
+def review_next_plan_user(db: Session, user: "User", now: datetime):
+    limited = user.data_limit and user.used_traffic >= user.data_limit
+    expired = user.expire and user.expire <= now.timestamp()
 
-                    if user.next_plan.fire_on_either:
-                        reset_user_by_next_report(db, user)
-                        continue
+    if user.next_plan.fire_on_either or (limited and expired):
+        reset_user_by_next_report(db, user)
+        return
 
-                    elif limited and expired:
-                        reset_user_by_next_report(db, user)
-                        continue
+    status = UserStatus.limited if limited else UserStatus.expired
+    xray.operations.remove_user(user)
+    update_user_status(db, user, status)
+    report_status_change(user, status)
 
-            if limited:
-                status = UserStatus.limited
-            elif expired:
-                status = UserStatus.expired
-            else:
-                if WEBHOOK_ADDRESS:
-                    add_notification_reminders(db, user, now)
-                continue
 
-            xray.operations.remove_user(user)
-            update_user_status(db, user, status)
+def report_status_change(user: "User", status: UserStatus):
+    report.status_change(username=user.username, status=status,
+                         user=UserResponse.model_validate(user), user_admin=user.admin)
 
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
+    logger.info(f"User \"{user.username}\" status changed to {status}")
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
 
-        for user in get_users(db, status=UserStatus.on_hold):
+def review_chunk(db: Session, user_ids: List[int], now: datetime):
+    limited = crud.get_limited_user_ids(db, user_ids)
+    expired = set(crud.get_expired_user_ids(db, user_ids, now)) - set(limited)
+    next_plan = crud.get_next_plan_user_ids(db, user_ids, now)
+    activated = crud.get_on_hold_user_ids_to_activate(db, user_ids, now)
 
-            if user.edit_at:
-                base_time = datetime.timestamp(user.edit_at)
-            else:
-                base_time = datetime.timestamp(user.created_at)
+    for status, ids, filters in ((UserStatus.limited, limited, crud.limited_users_filter()),
+                                 (UserStatus.expired, sorted(expired), crud.expired_users_filter(now))):
+        for user in crud.update_users_status(db, ids, status, filters):
+            xray.operations.remove_user(user)
+            report_status_change(user, status)
 
-            # Check if the user is online After or at 'base_time'
-            if user.online_at and base_time <= datetime.timestamp(user.online_at):
-                status = UserStatus.active
+    for user in crud.update_users_status(db, activated, UserStatus.active,
+                                         crud.on_hold_users_to_activate_filter(now), start_expire=True):
+        report_status_change(user, UserStatus.active)
 
-            elif user.on_hold_timeout and (datetime.timestamp(user.on_hold_timeout) <= (now_ts)):
-                # If the user didn't connect within the timeout period, change status to "Active"
-                status = UserStatus.active
+    if next_plan:
+        for user in get_users(db, ids=next_plan):
+            review_next_plan_user(db, user, now)
 
-            else:
-                continue
+    changed = set(limited) | expired | set(next_plan) | set(activated)
+    unchanged = [uid for uid in user_ids if uid not in changed]
+    if not unchanged:
+        return
 
-            update_user_status(db, user, status)
-            start_user_expire(db, user)
+    if WEBHOOK_ADDRESS:
+        for user in get_users(db, ids=unchanged, status=UserStatus.active):
+            add_notification_reminders(db, user, now)
 
-            report.status_change(username=user.username, status=status,
-                                 user=UserResponse.model_validate(user), user_admin=user.admin)
+    review_index.mark_reviewed(db, unchanged)
 
-            logger.info(f"User \"{user.username}\" status changed to {status}")
+
+def review():
+    now = datetime.utcnow()
+    user_ids, traffic_triggered = review_index.pop_due(now.timestamp())
+    if not user_ids:
+        return
+
+    if traffic_triggered:
+        # thresholds were passed by traffic which may not be written yet
+        accumulator.flush()
+
+    user_ids = sorted(user_ids)
+    try:
+        with GetDB() as db:
+            for i in range(0, len(user_ids), REVIEW_CHUNK_SIZE):
+                review_chunk(db, user_ids[i:i + REVIEW_CHUNK_SIZE], now)
+    except Exception:
+        review_index.invalidate()
+        raise
 
 
 scheduler.add_job(review, 'interval',
@@ -86,14 +86,15 @@ def get_core_stats(admin: Admin = Depends(Admin.get_current)):
 
 
 @router.post("/core/restart", responses={403: responses._403})
-def restart_core(admin: Admin = Depends(Admin.check_sudo_admin)):
+async def restart_core(admin: Admin = Depends(Admin.check_sudo_admin)):
     """Restart the core and all connected nodes."""
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
+    startup_config = await asyncio.to_thread(xray.config.include_db_users)
+    await asyncio.to_thread(xray.core.restart, startup_config)
 
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
+    node_ids = await asyncio.to_thread(
+        lambda: [node_id for node_id, node in list(xray.nodes.items()) if node.connected]
+    )
+    await xray.operations.restart_nodes_async(node_ids, startup_config)
 
     return {}
 
@@ -111,7 +112,7 @@ def get_core_config(admin: Admin = Depends(Admin.check_sudo_admin)) -> dict:
 def modify_core_config(
     payload: dict, admin: Admin = Depends(Admin.check_sudo_admin)
 ) -> dict:
-    """Modify the core configuration and restart the core."""
+    """Modify the core configuration and apply it, restarting the cores if inbounds or outbounds changed."""
     try:
         config = XRayConfig(payload, api_port=xray.config.api_port)
     except ValueError as err:
@@ -121,11 +122,7 @@ def modify_core_config(
     with open(XRAY_JSON, "w") as f:
         f.write(json.dumps(payload, indent=4))
 
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
+    xray.reconciler.reconcile()
 
     xray.hosts.update()
 
@@ -4,6 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException
 
 from app import __version__, xray
 from app.db import Session, crud, get_db
+from app.db.counts import users_counts
 from app.models.admin import Admin
 from app.models.proxy import ProxyHost, ProxyInbound, ProxyTypes
 from app.models.system import SystemStats
@@ -24,23 +25,9 @@ def get_system_stats(
     system = crud.get_system_usage(db)
     dbadmin: Union[Admin, None] = crud.get_admin(db, admin.username)
 
-    total_user = crud.get_users_count(db, admin=dbadmin if not admin.is_sudo else None)
-    users_active = crud.get_users_count(
-        db, status=UserStatus.active, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_disabled = crud.get_users_count(
-        db, status=UserStatus.disabled, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_on_hold = crud.get_users_count(
-        db, status=UserStatus.on_hold, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_expired = crud.get_users_count(
-        db, status=UserStatus.expired, admin=dbadmin if not admin.is_sudo else None
-    )
-    users_limited = crud.get_users_count(
-        db, status=UserStatus.limited, admin=dbadmin if not admin.is_sudo else None
-    )
-    online_users = crud.count_online_users(db, 24)
+    counts = users_counts.get(db, admin=dbadmin if not admin.is_sudo else None)
+    # online users are counted over all users, for every admin
+    online_users = counts["online"] if admin.is_sudo else users_counts.get(db)["online"]
     realtime_bandwidth_stats = realtime_bandwidth()
 
     return SystemStats(
@@ -49,13 +36,13 @@ def get_system_stats(
         mem_used=mem.used,
         cpu_cores=cpu.cores,
         cpu_usage=cpu.percent,
-        total_user=total_user,
+        total_user=counts["total"],
         online_users=online_users,
-        users_active=users_active,
-        users_disabled=users_disabled,
-        users_expired=users_expired,
-        users_limited=users_limited,
-        users_on_hold=users_on_hold,
+        users_active=counts[UserStatus.active],
+        users_disabled=counts[UserStatus.disabled],
+        users_expired=counts[UserStatus.expired],
+        users_limited=counts[UserStatus.limited],
+        users_on_hold=counts[UserStatus.on_hold],
         incoming_bandwidth=system.uplink,
         outgoing_bandwidth=system.downlink,
         incoming_bandwidth_speed=realtime_bandwidth_stats.incoming_bytes,
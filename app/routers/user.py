@@ -1,7 +1,9 @@
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Union
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from sqlalchemy.exc import IntegrityError
 
 from app import logger, xray
@@ -203,15 +205,24 @@ def revoke_user_subscription(
 def get_users(
     offset: int = None,
     limit: int = None,
+    cursor: str = None,
     username: List[str] = Query(None),
     search: Union[str, None] = None,
     owner: Union[List[str], None] = Query(None, alias="admin"),
     status: UserStatus = None,
     sort: str = None,
+    fields: str = None,
+    include_links: bool = True,
     db: Session = Depends(get_db),
     admin: Admin = Depends(Admin.get_current),
 ):
-    """Get all users"""
+    """
+    Get all users
+
+    - **cursor**: The `next_cursor` of the previous page, to get the next one without an offset. Works with a single sort option.
+    - **fields**: Comma separated fields of the users to return instead of the whole users, e.g. `username,status,used_traffic`.
+    - **include_links**: Whether to generate the share links of the users, pass `false` to skip them on large pages.
+    """
     if sort is not None:
         opts = sort.strip(",").split(",")
         sort = []
@@ -223,19 +234,53 @@ def get_users(
                     status_code=400, detail=f'"{opt}" is not a valid sort option'
                 )
 
-    users, count = crud.get_users(
-        db=db,
-        offset=offset,
-        limit=limit,
-        search=search,
-        usernames=username,
-        status=status,
-        sort=sort,
-        admins=owner if admin.is_sudo else [admin.username],
-        return_with_count=True,
-    )
+    if fields is not None:
+        fields = list(dict.fromkeys(fields.strip(",").split(",")))
+        for field in fields:
+            if field not in crud.USER_FIELDS:
+                raise HTTPException(
+                    status_code=400, detail=f'"{field}" is not a valid field'
+                )
+
+    try:
+        users, count = crud.get_users(
+            db=db,
+            offset=offset,
+            limit=limit,
+            search=search,
+            usernames=username,
+            status=status,
+            sort=sort,
+            admins=owner if admin.is_sudo else [admin.username],
+            cursor=cursor,
+            fields=fields,
+            load_relations=not fields,
+            return_with_count=True,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    next_cursor = None
+    if limit and len(users) == limit:
+        next_cursor = crud.get_users_cursor(users[-1], sort)
+
+    if fields:
+        return JSONResponse(content=jsonable_encoder({
+            "users": [{field: getattr(row, field) for field in fields} for row in users],
+            "total": count,
+            "next_cursor": next_cursor,
+        }))
+
+    if not include_links:
+        response = UsersResponse.model_validate(
+            {"users": users, "total": count, "next_cursor": next_cursor}, from_attributes=True
+        )
+        return Response(
+            content=response.model_dump_json(exclude={"users": {"__all__": {"links"}}}),
+            media_type="application/json",
+        )
 
-    return {"users": users, "total": count}
+    return {"users": users, "total": count, "next_cursor": next_cursor}
 
 
 @router.post("/users/reset", responses={403: responses._403, 404: responses._404})
@@ -245,11 +290,7 @@ def reset_users_data_usage(
     """Reset all users data usage"""
     dbadmin = crud.get_admin(db, admin.username)
     crud.reset_all_users_data_usage(db=db, admin=dbadmin)
-    startup_config = xray.config.include_db_users()
-    xray.core.restart(startup_config)
-    for node_id, node in list(xray.nodes.items()):
-        if node.connected:
-            xray.operations.restart_node(node_id, startup_config)
+    xray.reconciler.reconcile()
     return {"detail": "Users successfully reset."}
 
 
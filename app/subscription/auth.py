@@ -0,0 +1,107 @@
+"""
+Snapshots of the user fields subscription tokens are checked against, so
+validating a token doesn't load the user with its admin and next plan.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from typing import Dict, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from app.db import events
+from app.db.models import User
+from config import SUB_AUTH_CACHE_SIZE
+
+
+class UserAuth(NamedTuple):
+    id: int
+    created_at: datetime
+    sub_revoked_at: Optional[datetime]
+
+    def accepts(self, token_created_at: datetime) -> bool:
+        """Whether a token created at the given time is valid for the user."""
+        if self.created_at > token_created_at:
+            return False
+        if self.sub_revoked_at and self.sub_revoked_at > token_created_at:
+            return False
+        return True
+
+
+class UserAuthCache:
+    """LRU of username -> UserAuth, kept up to date by the user signals."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = Lock()
+        self._entries: "OrderedDict[str, UserAuth]" = OrderedDict()
+        self._usernames: Dict[int, str] = {}
+        self._version = 0  # increased on invalidation, so snapshots loaded before it aren't stored
+
+    def get(self, db: Session, username: str) -> Optional[UserAuth]:
+        """
+        Returns the auth snapshot of the user, loaded from the database if it isn't cached.
+
+        Args:
+            db (Session): Database session.
+            username (str): The username of the user.
+
+        Returns:
+            Optional[UserAuth]: The snapshot, None if the user doesn't exist.
+        """
+        with self._lock:
+            auth = self._entries.get(username)
+            if auth is not None:
+                self._entries.move_to_end(username)
+                return auth
+            version = self._version
+
+        row = db.query(User.id, User.created_at, User.sub_revoked_at) \
+            .filter(User.username == username) \
+            .first()
+        if row is None:
+            return None
+
+        auth = UserAuth(row.id, row.created_at, row.sub_revoked_at)
+        with self._lock:
+            if version != self._version:
+                return auth
+            self._entries[username] = auth
+            self._usernames[auth.id] = username
+            while len(self._entries) > self.size:
+                _, evicted = self._entries.popitem(last=False)
+                self._usernames.pop(evicted.id, None)
+        return auth
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self._version += 1
+            username = self._usernames.pop(user_id, None)
+            if username is not None:
+                self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._usernames.clear()
+
+
+auth_cache = UserAuthCache(SUB_AUTH_CACHE_SIZE)
+
+
+@events.user_updated.connect
+def _on_user_updated(dbuser: User):
+    # also drops the entry of the previous username of a renamed user
+    auth_cache.remove(dbuser.id)
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: User):
+    auth_cache.remove(dbuser.id)
+
+
+@events.users_updated.connect
+def _on_users_updated():
+    auth_cache.clear()
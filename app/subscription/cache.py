@@ -0,0 +1,264 @@
+"""
+Cache of rendered subscriptions, so polls of users which haven't changed
+don't render the templates and walk every host again.
+"""
+
+import hashlib
+import secrets
+import time
+from collections import OrderedDict
+from string import Formatter
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, NamedTuple, Optional, Set, Tuple
+
+from app import xray
+from app.db import events
+from app.models.user import UserResponse
+from app.subscription.share import generate_subscription, setup_format_variables
+from app.utils.metrics import metrics
+from config import SUB_CACHE_SIZE, SUB_CACHE_TTL
+
+if TYPE_CHECKING:
+    from app.db.models import User
+
+# ETags of a previous process may belong to other revisions
+_BOOT_ID = secrets.token_hex(8)
+
+# users whose revisions are kept, per cache entry
+REVISIONS_PER_ENTRY = 10
+MIN_REVISIONS = 10000
+
+# format variables which depend on the user's state or the time
+_USER_VARIABLES = {
+    "USERNAME", "DATA_USAGE", "DATA_LIMIT", "DATA_LEFT", "DAYS_LEFT",
+    "EXPIRE_DATE", "JALALI_EXPIRE_DATE", "TIME_LEFT", "STATUS_EMOJI", "STATUS_TEXT",
+}
+
+
+def _field_names(text: Optional[str]) -> Set[str]:
+    names = set()
+    if not text:
+        return names
+    for _, field_name, _, _ in Formatter().parse(text):
+        if field_name:
+            names.add(field_name.split('.')[0].split('[')[0])
+    return names
+
+
+def _format_data(dbuser: "User") -> dict:
+    # the fields setup_format_variables reads from the user
+    return {
+        "username": dbuser.username,
+        "status": dbuser.status,
+        "expire": dbuser.expire,
+        "on_hold_expire_duration": dbuser.on_hold_expire_duration,
+        "data_limit": dbuser.data_limit,
+        "used_traffic": dbuser.used_traffic,
+    }
+
+
+class CacheKey(NamedTuple):
+    user_id: int
+    generation: int
+    user_revision: int
+    config_revision: int
+    hosts_revision: Optional[int]
+    config_format: str
+    as_base64: bool
+    reverse: bool
+    variables: Tuple[str, ...]
+
+
+class RenderedSubscription(NamedTuple):
+    content: str
+    modified_at: float  # unix timestamp of the render
+
+
+class SubscriptionCache:
+    """
+    LRU cache of rendered subscriptions with a time to live.
+
+    Entries are keyed by the user's revision, which is increased by the user
+    signals, the revisions of the hosts and the core config, the client format,
+    and the values of the format variables (e.g. DAYS_LEFT, DATA_LEFT) which
+    are used in the hosts, so a subscription is rendered again as soon as
+    anything shown in it changes. Random choices of the hosts (SNI, host and
+    address) stay the same until the entry expires.
+
+    Revisions are kept for at most max_revisions users, once more users were
+    modified a new generation is started, which drops every entry.
+    """
+
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self.max_revisions = max(size * REVISIONS_PER_ENTRY, MIN_REVISIONS)
+        self._lock = Lock()
+        self._entries: "OrderedDict[CacheKey, Tuple[float, RenderedSubscription]]" = OrderedDict()
+        self._revisions: Dict[int, int] = {}
+        self._generation = 0
+
+        self._config = None
+        self._config_revision = 0
+        self._hosts_revision = None
+        self._variables: Set[str] = set()
+
+    def _used_variables(self) -> Set[str]:
+        xray.hosts.keys()  # loads the hosts on first use, so the revision is the loaded one
+        config, hosts_revision = xray.config, xray.hosts.revision
+        if config is self._config and hosts_revision == self._hosts_revision:
+            return self._variables
+
+        variables = set()
+        try:
+            for inbound_tag, inbound in config.inbounds_by_tag.items():
+                variables |= _field_names(inbound.get("path"))
+                for host in xray.hosts.get(inbound_tag, []):
+                    variables |= _field_names(host["remark"])
+                    variables |= _field_names(host["path"])
+                    for address in host["address"]:
+                        variables |= _field_names(address)
+        except ValueError:
+            # malformed placeholders
+            variables = _USER_VARIABLES
+
+        with self._lock:
+            if config is not self._config:
+                self._config = config
+                self._config_revision += 1
+                self._entries.clear()
+            self._hosts_revision = hosts_revision
+            self._variables = variables & _USER_VARIABLES
+        return self._variables
+
+    def key(self, dbuser: "User", config_format: str, as_base64: bool, reverse: bool) -> CacheKey:
+        """Returns the key of the user's subscription, it changes whenever the subscription does."""
+        variables = self._used_variables()
+        if variables:
+            format_variables = setup_format_variables(_format_data(dbuser))
+            values = tuple(str(format_variables[name]) for name in sorted(variables))
+        else:
+            values = ()
+
+        with self._lock:
+            return CacheKey(
+                dbuser.id,
+                self._generation,
+                self._revisions.get(dbuser.id, 0),
+                self._config_revision,
+                self._hosts_revision,
+                config_format,
+                as_base64,
+                reverse,
+                values,
+            )
+
+    @staticmethod
+    def etag(key: CacheKey, *extra) -> str:
+        """
+        Weak ETag of the subscription, the hosts' random choices may differ
+        between renders of the same key.
+        """
+        data = repr((_BOOT_ID, tuple(key), extra)).encode()
+        return f'W/"{hashlib.sha1(data).hexdigest()}"'
+
+    def get(self, key: CacheKey) -> Optional[RenderedSubscription]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, rendered = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return rendered
+
+    def set(self, key: CacheKey, rendered: RenderedSubscription):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, rendered)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                metrics.inc("subscription_cache_evictions")
+
+    def render(self, dbuser: "User", key: CacheKey) -> RenderedSubscription:
+        """
+        Returns the subscription of the user, rendered only if it isn't cached.
+
+        Args:
+            dbuser (User): The user.
+            key (CacheKey): Key of the subscription, from `key()`.
+
+        Returns:
+            RenderedSubscription: The subscription and the time it was rendered.
+        """
+        if self.size > 0:
+            rendered = self.get(key)
+            if rendered is not None:
+                metrics.inc("subscription_cache_hits")
+                return rendered
+            metrics.inc("subscription_cache_misses")
+
+        rendered = self._render(dbuser, key)
+        if self.size > 0:
+            self.set(key, rendered)
+        return rendered
+
+    def fill(self, dbuser: "User", key: CacheKey) -> bool:
+        """
+        Renders the subscription ahead of the client's request, if it isn't cached.
+
+        Returns:
+            bool: Whether the subscription was rendered.
+        """
+        with self._lock:
+            if key in self._entries:
+                return False
+        self.set(key, self._render(dbuser, key))
+        return True
+
+    @staticmethod
+    def _render(dbuser: "User", key: CacheKey) -> RenderedSubscription:
+        user = UserResponse.model_validate(dbuser)
+        content = generate_subscription(user=user,
+                                        config_format=key.config_format,
+                                        as_base64=key.as_base64,
+                                        reverse=key.reverse)
+        return RenderedSubscription(content, time.time())
+
+    def invalidate_user(self, user_id: int):
+        # entries of the previous revision aren't looked up anymore and get evicted
+        with self._lock:
+            self._revisions[user_id] = self._revisions.get(user_id, 0) + 1
+            if len(self._revisions) > self.max_revisions:
+                # a revision can't just be forgotten, clients may hold ETags of its earlier values
+                self._clear()
+                metrics.inc("subscription_cache_generation_resets")
+
+    def _clear(self):
+        self._generation += 1
+        self._revisions.clear()
+        self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+
+cache = SubscriptionCache(SUB_CACHE_SIZE, SUB_CACHE_TTL)
+
+
+@events.user_updated.connect
+def _on_user_updated(dbuser: "User"):
+    cache.invalidate_user(dbuser.id)
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: "User"):
+    cache.invalidate_user(dbuser.id)
+
+
+@events.users_updated.connect
+def _on_users_updated():
+    cache.clear()
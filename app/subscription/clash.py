@@ -1,14 +1,13 @@
 import copy
 import json
 from random import choice
-from uuid import UUID
 
 import yaml
 from jinja2.exceptions import TemplateNotFound
 
 from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
-from app.utils.helpers import yml_uuid_representer
+from app.templates import env, load_template, parse_yaml
+from app.utils.helpers import YAMLDumper, copy_json
 from config import (
     CLASH_SETTINGS_TEMPLATE,
     CLASH_SUBSCRIPTION_TEMPLATE,
@@ -17,6 +16,20 @@ from config import (
 )
 
 
+def _to_yaml(obj):
+    if not obj:
+        return ""
+
+    return yaml.dump(obj, Dumper=YAMLDumper, allow_unicode=True, indent=2)
+
+
+# templates rendered with libyaml's dumper for the "yaml" filter, overlays share
+# the filters of the base environment so they get their own copy, and their own
+# template cache since compiled templates are bound to their environment
+_env = env.overlay(cache_size=400)
+_env.filters = {**env.filters, "yaml": _to_yaml}
+
+
 class ClashConfiguration(object):
     def __init__(self):
         self.data = {
@@ -26,8 +39,8 @@ class ClashConfiguration(object):
             'rules': []
         }
         self.proxy_remarks = []
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.mux_template = load_template(MUX_TEMPLATE, json.loads)
+        user_agent_data = load_template(USER_AGENT_TEMPLATE, json.loads)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
@@ -35,7 +48,7 @@ class ClashConfiguration(object):
             self.user_agent_list = []
 
         try:
-            self.settings = yaml.load(render_template(CLASH_SETTINGS_TEMPLATE), Loader=yaml.SafeLoader)
+            self.settings = load_template(CLASH_SETTINGS_TEMPLATE, parse_yaml)
         except TemplateNotFound:
             self.settings = {}
 
@@ -45,15 +58,13 @@ class ClashConfiguration(object):
         if reverse:
             self.data['proxies'].reverse()
 
-        yaml.add_representer(UUID, yml_uuid_representer)
+        # the template's output is parsed again, so it's rendered and parsed with libyaml,
+        # the final dump stays pure python which doesn't escape emojis
         return yaml.dump(
-            yaml.load(
-                render_template(
-                    CLASH_SUBSCRIPTION_TEMPLATE,
+            parse_yaml(
+                _env.get_template(CLASH_SUBSCRIPTION_TEMPLATE).render(
                     {"conf": self.data, "proxy_remarks": self.proxy_remarks}
-                ),
-                Loader=yaml.SafeLoader
-
+                )
             ),
             sort_keys=False,
             allow_unicode=True,
@@ -245,7 +256,7 @@ class ClashConfiguration(object):
 
         node[f'{network}-opts'] = net_opts
 
-        mux_json = json.loads(self.mux_template)
+        mux_json = copy_json(self.mux_template)
         mux_config = mux_json["clash"]
 
         if mux_enable:
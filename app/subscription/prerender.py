@@ -0,0 +1,99 @@
+"""
+Renders the subscriptions of the recently polling users into the cache
+after the hosts or the core config change, before their clients re-poll
+all at once.
+"""
+
+import time
+from typing import List
+
+from app import logger, xray
+from app.db import GetDB, crud
+from app.db.models import User
+from app.models.user import UserStatus
+from app.subscription.cache import cache
+from app.subscription.user_agent import get_client_config
+from app.utils.metrics import metrics
+from config import SUB_PRERENDER_RATE
+
+PRERENDER_CHUNK_SIZE = 100
+
+
+class PreRenderer:
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._config = None
+        self._hosts_revision = None
+
+    def _revision(self) -> tuple:
+        xray.hosts.keys()  # loads the hosts on first use
+        return xray.config, xray.hosts.revision
+
+    def changed(self) -> bool:
+        """Whether the hosts or the core config changed since the last walk."""
+        config, hosts_revision = self._revision()
+        if self._config is None:
+            # nothing to refresh on startup
+            self._config, self._hosts_revision = config, hosts_revision
+            return False
+        return config is not self._config or hosts_revision != self._hosts_revision
+
+    @staticmethod
+    def _get_user_ids(limit: int) -> List[int]:
+        with GetDB() as db:
+            rows = db.query(User.id) \
+                .filter(User.status.in_([UserStatus.active, UserStatus.on_hold])) \
+                .filter(User.sub_last_user_agent.isnot(None)) \
+                .order_by(User.sub_updated_at.desc()) \
+                .limit(limit) \
+                .all()
+        return [row.id for row in rows]
+
+    def run(self):
+        """
+        Renders the subscriptions in the format of each user's last user agent,
+        most recently polling users first and at most as many as the cache holds.
+
+        Stops early if the hosts or the core config change again, the next run
+        starts over.
+        """
+        revision = self._revision()
+        self._config, self._hosts_revision = revision
+
+        if self.rate <= 0 or cache.size <= 0:
+            return
+
+        user_ids = self._get_user_ids(cache.size)
+        metrics.set("subscription_prerender_total", len(user_ids))
+        metrics.set("subscription_prerender_done", 0)
+        logger.info(f"Pre-rendering subscriptions of {len(user_ids)} users")
+
+        interval = 1 / self.rate
+        done = 0
+        for i in range(0, len(user_ids), PRERENDER_CHUNK_SIZE):
+            if self._revision() != revision:
+                logger.info("Hosts or core config changed, pre-rendering subscriptions stopped")
+                return
+
+            with GetDB() as db:
+                for dbuser in crud.get_users(db, ids=user_ids[i:i + PRERENDER_CHUNK_SIZE]):
+                    started_at = time.monotonic()
+                    config = get_client_config(dbuser.sub_last_user_agent)
+                    key = cache.key(dbuser,
+                                    config_format=config["config_format"],
+                                    as_base64=config["as_base64"],
+                                    reverse=config["reverse"])
+                    try:
+                        if cache.fill(dbuser, key):
+                            metrics.inc("subscription_prerender_rendered")
+                            time.sleep(max(0.0, interval - (time.monotonic() - started_at)))
+                    except Exception:
+                        logger.exception(f"Unable to pre-render subscription of user \"{dbuser.username}\"")
+
+                    done += 1
+                    metrics.set("subscription_prerender_done", done)
+
+        logger.info(f"Pre-rendered subscriptions of {done} users")
+
+
+prerenderer = PreRenderer(SUB_PRERENDER_RATE)
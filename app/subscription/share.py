@@ -4,7 +4,9 @@ import secrets
 from collections import defaultdict
 from datetime import datetime as dt
 from datetime import timedelta
-from typing import TYPE_CHECKING, List, Literal, Union
+from threading import Lock
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Literal, Mapping, NamedTuple, Tuple, Union
 
 from jdatetime import date as jd
 
@@ -229,6 +231,88 @@ def setup_format_variables(extra_data: dict) -> dict:
     return format_variables
 
 
+class HostPlan(NamedTuple):
+    remark: str
+    address: Tuple[str, ...]
+    sni: Tuple[str, ...]
+    host: Tuple[str, ...]
+    sids: Tuple[str, ...]
+    path: str
+    use_sni_as_host: bool
+    inbound: Mapping  # the inbound merged with the host's settings
+
+
+class RenderPlan(NamedTuple):
+    index: Dict[str, int]  # position of each inbound tag in the core config
+    transports: Dict[str, str]
+    hosts: Dict[str, Tuple[HostPlan, ...]]
+
+
+def build_render_plan(inbounds_by_tag: dict, hosts: dict) -> RenderPlan:
+    """
+    Merges the hosts of each inbound with the inbound's defaults, leaving
+    the user's format variables and the random choices to each request.
+    """
+    plan_hosts = {}
+    for tag, inbound in inbounds_by_tag.items():
+        host_plans = []
+        for host in hosts.get(tag, []):
+            host_inbound = inbound.copy()
+            host_inbound.update(
+                {
+                    "port": host["port"] or inbound["port"],
+                    "tls": inbound["tls"] if host["tls"] is None else host["tls"],
+                    "alpn": host["alpn"] if host["alpn"] else None,
+                    "fp": host["fingerprint"] or inbound.get("fp", ""),
+                    "ais": host["allowinsecure"]
+                    or inbound.get("allowinsecure", ""),
+                    "mux_enable": host["mux_enable"],
+                    "fragment_setting": host["fragment_setting"],
+                    "noise_setting": host["noise_setting"],
+                    "random_user_agent": host["random_user_agent"],
+                }
+            )
+            host_plans.append(HostPlan(
+                remark=host["remark"],
+                address=tuple(host["address"] or ()),
+                sni=tuple(host["sni"] or inbound["sni"] or ()),
+                host=tuple(host["host"] or inbound["host"] or ()),
+                sids=tuple(inbound.get("sids") or ()),
+                path=host["path"] if host["path"] is not None else inbound.get("path", ""),
+                use_sni_as_host=host.get("use_sni_as_host", False),
+                inbound=MappingProxyType(host_inbound),
+            ))
+        plan_hosts[tag] = tuple(host_plans)
+
+    return RenderPlan(
+        index={tag: index for index, tag in enumerate(inbounds_by_tag)},
+        transports={tag: inbound["network"] for tag, inbound in inbounds_by_tag.items()},
+        hosts=plan_hosts,
+    )
+
+
+_render_plan_lock = Lock()
+_render_plan: Tuple[object, int, RenderPlan] = (None, None, None)
+
+
+def get_render_plan() -> RenderPlan:
+    """Returns the render plan of the current core config and hosts, rebuilt after either changes."""
+    global _render_plan
+
+    xray.hosts.keys()  # loads the hosts on first use, so the revision is the loaded one
+    config, hosts_revision = xray.config, xray.hosts.revision
+    plan_config, plan_hosts_revision, plan = _render_plan
+    if plan_config is config and plan_hosts_revision == hosts_revision:
+        return plan
+
+    with _render_plan_lock:
+        plan_config, plan_hosts_revision, plan = _render_plan
+        if plan_config is not config or plan_hosts_revision != hosts_revision:
+            plan = build_render_plan(config.inbounds_by_tag, xray.hosts)
+            _render_plan = (config, hosts_revision, plan)
+    return plan
+
+
 def process_inbounds_and_tags(
         inbounds: dict,
         proxies: dict,
@@ -243,82 +327,61 @@ def process_inbounds_and_tags(
         ],
         reverse=False,
 ) -> Union[List, str]:
+    plan = get_render_plan()
     _inbounds = []
     for protocol, tags in inbounds.items():
         for tag in tags:
-            _inbounds.append((protocol, [tag]))
-    index_dict = {proxy: index for index, proxy in enumerate(
-        xray.config.inbounds_by_tag.keys())}
+            _inbounds.append((protocol, tag))
     inbounds = sorted(
-        _inbounds, key=lambda x: index_dict.get(x[1][0], float('inf')))
+        _inbounds, key=lambda x: plan.index.get(x[1], float('inf')))
 
-    for protocol, tags in inbounds:
+    for protocol, tag in inbounds:
         settings = proxies.get(protocol)
         if not settings:
             continue
 
-        format_variables.update({"PROTOCOL": protocol.name})
-        for tag in tags:
-            inbound = xray.config.inbounds_by_tag.get(tag)
-            if not inbound:
-                continue
+        if tag not in plan.index:
+            continue
 
-            format_variables.update({"TRANSPORT": inbound["network"]})
-            host_inbound = inbound.copy()
-            for host in xray.hosts.get(tag, []):
-                sni = ""
-                sni_list = host["sni"] or inbound["sni"]
-                if sni_list:
-                    salt = secrets.token_hex(8)
-                    sni = random.choice(sni_list).replace("*", salt)
-
-                if sids := inbound.get("sids"):
-                    inbound["sid"] = random.choice(sids)
-
-                req_host = ""
-                req_host_list = host["host"] or inbound["host"]
-                if req_host_list:
-                    salt = secrets.token_hex(8)
-                    req_host = random.choice(req_host_list).replace("*", salt)
-
-                address = ""
-                address_list = host['address']
-                if host['address']:
-                    salt = secrets.token_hex(8)
-                    address = random.choice(address_list).replace('*', salt)
-
-                if host["path"] is not None:
-                    path = host["path"].format_map(format_variables)
-                else:
-                    path = inbound.get("path", "").format_map(format_variables)
-
-                if host.get("use_sni_as_host", False) and sni:
-                    req_host = sni
-
-                host_inbound.update(
-                    {
-                        "port": host["port"] or inbound["port"],
-                        "sni": sni,
-                        "host": req_host,
-                        "tls": inbound["tls"] if host["tls"] is None else host["tls"],
-                        "alpn": host["alpn"] if host["alpn"] else None,
-                        "path": path,
-                        "fp": host["fingerprint"] or inbound.get("fp", ""),
-                        "ais": host["allowinsecure"]
-                        or inbound.get("allowinsecure", ""),
-                        "mux_enable": host["mux_enable"],
-                        "fragment_setting": host["fragment_setting"],
-                        "noise_setting": host["noise_setting"],
-                        "random_user_agent": host["random_user_agent"],
-                    }
-                )
-
-                conf.add(
-                    remark=host["remark"].format_map(format_variables),
-                    address=address.format_map(format_variables),
-                    inbound=host_inbound,
-                    settings=settings.model_dump()
-                )
+        format_variables.update({"PROTOCOL": protocol.name, "TRANSPORT": plan.transports[tag]})
+        settings_dump = settings.model_dump()
+        for host in plan.hosts[tag]:
+            sni = ""
+            if host.sni:
+                salt = secrets.token_hex(8)
+                sni = random.choice(host.sni).replace("*", salt)
+
+            host_inbound = dict(host.inbound)
+            if host.sids:
+                host_inbound["sid"] = random.choice(host.sids)
+
+            req_host = ""
+            if host.host:
+                salt = secrets.token_hex(8)
+                req_host = random.choice(host.host).replace("*", salt)
+
+            address = ""
+            if host.address:
+                salt = secrets.token_hex(8)
+                address = random.choice(host.address).replace('*', salt)
+
+            if host.use_sni_as_host and sni:
+                req_host = sni
+
+            host_inbound.update(
+                {
+                    "sni": sni,
+                    "host": req_host,
+                    "path": host.path.format_map(format_variables),
+                }
+            )
+
+            conf.add(
+                remark=host.remark.format_map(format_variables),
+                address=address.format_map(format_variables),
+                inbound=host_inbound,
+                settings=settings_dump
+            )
 
     return conf.render(reverse=reverse)
 
@@ -2,11 +2,11 @@ import copy
 import json
 from random import choice
 
-from app.utils.helpers import UUIDEncoder
+from app.utils.helpers import UUIDEncoder, copy_json
 from jinja2.exceptions import TemplateNotFound
 
 from app.subscription.funcs import get_grpc_gun
-from app.templates import render_template
+from app.templates import load_template
 from config import (
     MUX_TEMPLATE,
     SINGBOX_SETTINGS_TEMPLATE,
@@ -19,9 +19,9 @@ class SingBoxConfiguration(str):
 
     def __init__(self):
         self.proxy_remarks = []
-        self.config = json.loads(render_template(SINGBOX_SUBSCRIPTION_TEMPLATE))
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.config = load_template(SINGBOX_SUBSCRIPTION_TEMPLATE, json.loads)
+        self.mux_template = load_template(MUX_TEMPLATE, json.loads)
+        user_agent_data = load_template(USER_AGENT_TEMPLATE, json.loads)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
@@ -29,7 +29,7 @@ class SingBoxConfiguration(str):
             self.user_agent_list = []
 
         try:
-            self.settings = json.loads(render_template(SINGBOX_SETTINGS_TEMPLATE))
+            self.settings = load_template(SINGBOX_SETTINGS_TEMPLATE, json.loads)
         except TemplateNotFound:
             self.settings = {}
 
@@ -274,7 +274,7 @@ class SingBoxConfiguration(str):
                                             pbk=pbk, sid=sid, alpn=alpn,
                                             ais=ais)
 
-        mux_json = json.loads(self.mux_template)
+        mux_json = copy_json(self.mux_template)
         mux_config = mux_json["sing-box"]
 
         config['multiplex'] = mux_config
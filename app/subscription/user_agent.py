@@ -0,0 +1,161 @@
+"""
+Subscription formats of the clients, picked based on their user agent.
+
+The rules are read from the USER_AGENT_RULES_TEMPLATE file, in order, the
+first rule whose pattern matches the user agent decides the format:
+
+    {
+        "pattern": "^v2rayNG/(?P<version>\\d+\\.\\d+\\.\\d+)",
+        "enabled_by": ["USE_CUSTOM_JSON_DEFAULT", "USE_CUSTOM_JSON_FOR_V2RAYNG"],
+        "versions": [{"min": "1.8.29", "format": "v2ray-json"}],
+        "format": "v2ray"
+    }
+
+"enabled_by" skips the rule unless one of the settings is enabled, and
+"versions" picks the format by the "version" group of the pattern, the
+first one whose "min" isn't greater than it wins, "format" is used otherwise.
+"""
+
+import json
+import re
+import time
+from functools import lru_cache
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app import logger
+from app.templates import env
+from config import (
+    USE_CUSTOM_JSON_DEFAULT,
+    USE_CUSTOM_JSON_FOR_HAPP,
+    USE_CUSTOM_JSON_FOR_STREISAND,
+    USE_CUSTOM_JSON_FOR_V2RAYN,
+    USE_CUSTOM_JSON_FOR_V2RAYNG,
+    USER_AGENT_RULES_TEMPLATE,
+)
+
+client_config = {
+    "clash-meta": {"config_format": "clash-meta", "media_type": "text/yaml", "as_base64": False, "reverse": False},
+    "sing-box": {"config_format": "sing-box", "media_type": "application/json", "as_base64": False, "reverse": False},
+    "clash": {"config_format": "clash", "media_type": "text/yaml", "as_base64": False, "reverse": False},
+    "v2ray": {"config_format": "v2ray", "media_type": "text/plain", "as_base64": True, "reverse": False},
+    "outline": {"config_format": "outline", "media_type": "application/json", "as_base64": False, "reverse": False},
+    "v2ray-json": {"config_format": "v2ray-json", "media_type": "application/json", "as_base64": False,
+                   "reverse": False}
+}
+
+# settings which can enable rules
+RULE_FLAGS = {
+    "USE_CUSTOM_JSON_DEFAULT": USE_CUSTOM_JSON_DEFAULT,
+    "USE_CUSTOM_JSON_FOR_V2RAYN": USE_CUSTOM_JSON_FOR_V2RAYN,
+    "USE_CUSTOM_JSON_FOR_V2RAYNG": USE_CUSTOM_JSON_FOR_V2RAYNG,
+    "USE_CUSTOM_JSON_FOR_STREISAND": USE_CUSTOM_JSON_FOR_STREISAND,
+    "USE_CUSTOM_JSON_FOR_HAPP": USE_CUSTOM_JSON_FOR_HAPP,
+}
+
+USER_AGENT_CACHE_SIZE = 1024
+RULES_CHECK_INTERVAL = 1  # seconds between checks of the rules file for changes
+
+
+def parse_version(version: str) -> Tuple[int, ...]:
+    return tuple(int(i) for i in re.findall(r'\d+', version))
+
+
+def _get_config(rule: dict, reverse: Optional[bool] = None) -> dict:
+    if rule["format"] not in client_config:
+        raise ValueError(f'Unsupported format "{rule["format"]}"')
+    config = client_config[rule["format"]]
+    if reverse is not None and reverse != config["reverse"]:
+        config = {**config, "reverse": reverse}
+    return config
+
+
+def compile_rules(rules: List[dict]) -> Callable[[str], dict]:
+    """
+    Compiles the rules into one pattern, so a user agent is matched in a single pass.
+
+    Returns:
+        Callable[[str], dict]: Returns the client config of a user agent, memoized per user agent.
+    """
+    patterns = []
+    decisions: Dict[int, Tuple[Optional[str], dict, List[Tuple[Tuple[int, ...], dict]]]] = {}
+
+    for i, rule in enumerate(rules):
+        enabled_by = rule.get("enabled_by")
+        if enabled_by:
+            unknown = set(enabled_by) - RULE_FLAGS.keys()
+            if unknown:
+                raise ValueError(f"Unknown settings in user agent rule: {', '.join(sorted(unknown))}")
+            if not any(RULE_FLAGS[flag] for flag in enabled_by):
+                continue
+
+        pattern = rule["pattern"]
+        re.compile(pattern)  # reports errors of the rule itself
+        version_group = None
+        if "(?P<version>" in pattern:
+            version_group = f"v{i}"
+            pattern = pattern.replace("(?P<version>", f"(?P<{version_group}>")
+        patterns.append(f"(?P<r{i}>{pattern})")
+
+        versions = sorted(
+            ((parse_version(v["min"]), _get_config(v, v.get("reverse"))) for v in rule.get("versions", [])),
+            key=lambda v: v[0],
+            reverse=True,
+        )
+        decisions[i] = (version_group, _get_config(rule, rule.get("reverse")), versions)
+
+    default = client_config["v2ray"]
+    if not patterns:
+        return lambda user_agent: default
+
+    combined = re.compile("|".join(patterns))
+    rule_by_group = {combined.groupindex[f"r{i}"]: i for i in decisions}
+
+    @lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+    def dispatch(user_agent: str) -> dict:
+        match = combined.match(user_agent)
+        if not match:
+            return default
+
+        version_group, config, versions = decisions[rule_by_group[match.lastindex]]
+        if version_group and versions:
+            version = parse_version(match.group(version_group) or "")
+            for min_version, version_config in versions:
+                if version >= min_version:
+                    return version_config
+        return config
+
+    return dispatch
+
+
+class UserAgentDispatcher:
+    def __init__(self, template: str):
+        self.template = template
+        self._lock = Lock()
+        self._source = None
+        self._checked_at = float('-inf')
+        self._dispatch: Callable[[str], dict] = lambda user_agent: client_config["v2ray"]
+
+    def _reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < RULES_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+
+        with self._lock:
+            try:
+                # jinja gives a new template object once the file is modified
+                source = env.get_template(self.template)
+                if source is self._source:
+                    return
+                self._source = source
+                self._dispatch = compile_rules(json.loads(source.render()))
+            except Exception:
+                logger.exception(f"Unable to load user agent rules from \"{self.template}\"")
+
+    def __call__(self, user_agent: str) -> dict:
+        self._reload()
+        return self._dispatch(user_agent)
+
+
+get_client_config = UserAgentDispatcher(USER_AGENT_RULES_TEMPLATE)
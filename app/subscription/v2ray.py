@@ -10,8 +10,8 @@ from uuid import UUID
 from jinja2.exceptions import TemplateNotFound
 
 from app.subscription.funcs import get_grpc_gun, get_grpc_multi
-from app.templates import render_template
-from app.utils.helpers import UUIDEncoder
+from app.templates import load_template
+from app.utils.helpers import UUIDEncoder, copy_json
 from config import (
     EXTERNAL_CONFIG,
     GRPC_USER_AGENT_TEMPLATE,
@@ -489,16 +489,16 @@ class V2rayJsonConfig(str):
 
     def __init__(self):
         self.config = []
-        self.template = render_template(V2RAY_SUBSCRIPTION_TEMPLATE)
-        self.mux_template = render_template(MUX_TEMPLATE)
-        user_agent_data = json.loads(render_template(USER_AGENT_TEMPLATE))
+        self.template = load_template(V2RAY_SUBSCRIPTION_TEMPLATE, json.loads)
+        self.mux_template = load_template(MUX_TEMPLATE, json.loads)
+        user_agent_data = load_template(USER_AGENT_TEMPLATE, json.loads)
 
         if 'list' in user_agent_data and isinstance(user_agent_data['list'], list):
             self.user_agent_list = user_agent_data['list']
         else:
             self.user_agent_list = []
 
-        grpc_user_agent_data = json.loads(render_template(GRPC_USER_AGENT_TEMPLATE))
+        grpc_user_agent_data = load_template(GRPC_USER_AGENT_TEMPLATE, json.loads)
 
         if 'list' in grpc_user_agent_data and isinstance(grpc_user_agent_data['list'], list):
             self.grpc_user_agent_data = grpc_user_agent_data['list']
@@ -506,14 +506,14 @@ class V2rayJsonConfig(str):
             self.grpc_user_agent_data = []
 
         try:
-            self.settings = json.loads(render_template(V2RAY_SETTINGS_TEMPLATE))
+            self.settings = load_template(V2RAY_SETTINGS_TEMPLATE, json.loads)
         except TemplateNotFound:
             self.settings = {}
 
         del user_agent_data, grpc_user_agent_data
 
     def add_config(self, remarks, outbounds):
-        json_template = json.loads(self.template)
+        json_template = copy_json(self.template)
         json_template["remarks"] = remarks
         json_template["outbounds"] = outbounds + json_template["outbounds"]
         self.config.append(json_template)
@@ -1072,7 +1072,7 @@ class V2rayJsonConfig(str):
             keepAlivePeriod=inbound.get("keepAlivePeriod", 0),
         )
 
-        mux_json = json.loads(self.mux_template)
+        mux_json = copy_json(self.mux_template)
         mux_config = mux_json["v2ray"]
 
         if inbound.get('mux_enable', False):
@@ -16,6 +16,7 @@ from telebot.util import extract_arguments, user_link
 
 from app import xray
 from app.db import GetDB, crud
+from app.db.counts import users_counts
 from app.models.proxy import ProxyTypes
 from app.models.user import (
     UserCreate,
@@ -47,9 +48,10 @@ def get_system_info():
     cpu = cpu_usage()
     with GetDB() as db:
         bandwidth = crud.get_system_usage(db)
-        total_users = crud.get_users_count(db)
-        active_users = crud.get_users_count(db, UserStatus.active)
-        onhold_users = crud.get_users_count(db, UserStatus.on_hold)
+        counts = users_counts.get(db)
+        total_users = counts["total"]
+        active_users = counts[UserStatus.active]
+        onhold_users = counts[UserStatus.on_hold]
     return """\
 🎛 *CPU Cores*: `{cpu_cores}`
 🖥 *CPU Usage*: `{cpu_percent}%`
@@ -194,19 +196,14 @@ def reset_usage_user_command(call: types.CallbackQuery):
 @bot.callback_query_handler(cb_query_equals('edit_all'), is_admin=True)
 def edit_all_command(call: types.CallbackQuery):
     with GetDB() as db:
-        total_users = crud.get_users_count(db)
-        active_users = crud.get_users_count(db, UserStatus.active)
-        disabled_users = crud.get_users_count(db, UserStatus.disabled)
-        expired_users = crud.get_users_count(db, UserStatus.expired)
-        limited_users = crud.get_users_count(db, UserStatus.limited)
-        onhold_users = crud.get_users_count(db, UserStatus.on_hold)
-        text = f"""
-👥 *Total Users*: `{total_users}`
-✅ *Active Users*: `{active_users}`
-❌ *Disabled Users*: `{disabled_users}`
-🕰 *Expired Users*: `{expired_users}`
-🪫 *Limited Users*: `{limited_users}`
-🔌 *OnHold Users*: `{onhold_users}`"""
+        counts = users_counts.get(db)
+    text = f"""
+👥 *Total Users*: `{counts['total']}`
+✅ *Active Users*: `{counts[UserStatus.active]}`
+❌ *Disabled Users*: `{counts[UserStatus.disabled]}`
+🕰 *Expired Users*: `{counts[UserStatus.expired]}`
+🪫 *Limited Users*: `{counts[UserStatus.limited]}`
+🔌 *OnHold Users*: `{counts[UserStatus.on_hold]}`"""
     return bot.edit_message_text(
         text,
         call.message.chat.id,
@@ -1,12 +1,22 @@
 from datetime import datetime
-from typing import Union
+from typing import Any, Callable, Dict, Tuple, Union
 
 import jinja2
+import jinja2.meta
+import jinja2.nodes
+import yaml
 
+from app.utils.helpers import copy_json
 from config import CUSTOM_TEMPLATES_DIRECTORY
 
 from .filters import CUSTOM_FILTERS
 
+try:
+    # libyaml bindings, several times faster than the pure python ones
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 template_directories = ["app/templates"]
 if CUSTOM_TEMPLATES_DIRECTORY:
     # User's templates have priority over default templates
@@ -19,3 +29,55 @@ env.globals['now'] = datetime.utcnow
 
 def render_template(template: str, context: Union[dict, None] = None) -> str:
     return env.get_template(template).render(context or {})
+
+
+def parse_yaml(text: str) -> Any:
+    return yaml.load(text, Loader=_SafeLoader)
+
+
+# (template, parser) -> (jinja template the data was parsed from, parsed data)
+_parsed_templates: Dict[Tuple[str, Callable], Tuple[jinja2.Template, Any]] = {}
+
+# template -> (jinja template, whether its output depends on the render time)
+_dynamic_templates: Dict[str, Tuple[jinja2.Template, bool]] = {}
+
+
+def _is_dynamic(template: str, jinja_template: jinja2.Template) -> bool:
+    cached = _dynamic_templates.get(template)
+    if cached is None or cached[0] is not jinja_template:
+        source = env.loader.get_source(env, template)[0]
+        ast = env.parse(source)
+        # included templates aren't checked, so treat them as dynamic too
+        dynamic = any(node.name == 'now' for node in ast.find_all(jinja2.nodes.Name)) \
+            or any(True for _ in jinja2.meta.find_referenced_templates(ast))
+        cached = (jinja_template, dynamic)
+        _dynamic_templates[template] = cached
+    return cached[1]
+
+
+def load_template(template: str, parser: Callable[[str], Any]) -> Any:
+    """
+    Renders the template without context and parses it.
+
+    The parsed data is kept until the template's file is modified, jinja checks
+    its modification time and loads it again. Templates which use `now` (or
+    include other templates) are rendered and parsed on every call, so their
+    output stays current. Each call returns a copy of the data, which can be
+    modified by the caller.
+
+    Args:
+        template (str): Name of the template.
+        parser (Callable[[str], Any]): Parses the rendered text, e.g. json.loads or parse_yaml.
+
+    Returns:
+        Any: The parsed data.
+    """
+    jinja_template = env.get_template(template)
+    if _is_dynamic(template, jinja_template):
+        return parser(jinja_template.render())
+
+    cached = _parsed_templates.get((template, parser))
+    if cached is None or cached[0] is not jinja_template:
+        cached = (jinja_template, parser(jinja_template.render()))
+        _parsed_templates[(template, parser)] = cached
+    return copy_json(cached[1])
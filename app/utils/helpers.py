@@ -1,7 +1,14 @@
+import copy
 import json
 from datetime import datetime as dt
 from uuid import UUID
 
+try:
+    # libyaml bindings, several times faster than the pure python ones
+    from yaml import CDumper as _Dumper
+except ImportError:
+    from yaml import Dumper as _Dumper
+
 
 def calculate_usage_percent(used_traffic: int, data_limit: int) -> float:
     return (used_traffic * 100) / data_limit
@@ -11,10 +18,32 @@ def calculate_expiration_days(expire: int) -> int:
     return (dt.fromtimestamp(expire) - dt.utcnow()).days
 
 
+def copy_json(obj):
+    """Copies JSON-like data, much faster than copy.deepcopy as scalars are shared."""
+    if isinstance(obj, dict):
+        return {key: copy_json(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [copy_json(value) for value in obj]
+    if obj is None or isinstance(obj, (str, int, float)):
+        return obj
+    return copy.deepcopy(obj)
+
+
 def yml_uuid_representer(dumper, data):
     return dumper.represent_scalar('tag:yaml.org,2002:str', str(data))
 
 
+class YAMLDumper(_Dumper):
+    """
+    Dumper backed by libyaml when available. libyaml escapes characters
+    outside the BMP (e.g. emojis) even with allow_unicode, so it's meant
+    for YAML which is parsed again rather than shown as is.
+    """
+
+
+YAMLDumper.add_representer(UUID, yml_uuid_representer)
+
+
 class UUIDEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, UUID):
@@ -5,10 +5,10 @@ from datetime import datetime, timedelta
 from functools import lru_cache
 from hashlib import sha256
 from math import ceil
-from typing import Union
+from typing import NamedTuple, Union
 
 
-from config import JWT_ACCESS_TOKEN_EXPIRE_MINUTES
+from config import JWT_ACCESS_TOKEN_EXPIRE_MINUTES, SUB_AUTH_CACHE_SIZE
 
 
 @lru_cache(maxsize=None)
@@ -57,34 +57,47 @@ def create_subscription_token(username: str) -> str:
     return data_final
 
 
-def get_subscription_payload(token: str) -> Union[dict, None]:
-    try:
-        if len(token) < 15:
-            return
+class SubscriptionPayload(NamedTuple):
+    username: str
+    created_at: datetime
+
 
-        if token.startswith("eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9."):
-            payload = jwt.decode(token, get_secret_key(), algorithms=["HS256"])
-            if payload.get("access") == "subscription":
-                return {"username": payload['sub'], "created_at": datetime.utcfromtimestamp(payload['iat'])}
-            else:
-                return
+# tokens are verified once, the payload only depends on the token and the secret key,
+# it's shared by every request with the token so it's immutable. invalid tokens raise
+# instead of returning None, so they aren't cached and can't evict valid ones
+@lru_cache(maxsize=SUB_AUTH_CACHE_SIZE)
+def _decode_subscription_token(token: str) -> SubscriptionPayload:
+    if len(token) < 15:
+        raise ValueError("token is too short")
+
+    if token.startswith("eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9."):
+        payload = jwt.decode(token, get_secret_key(), algorithms=["HS256"])
+        if payload.get("access") == "subscription":
+            return SubscriptionPayload(payload['sub'], datetime.utcfromtimestamp(payload['iat']))
         else:
-            u_token = token[:-10]
-            u_signature = token[-10:]
-            try:
-                u_token_dec = b64decode(
-                    (u_token.encode('utf-8') + b'=' * (-len(u_token.encode('utf-8')) % 4)),
-                    altchars=b'-_', validate=True)
-                u_token_dec_str = u_token_dec.decode('utf-8')
-            except:
-                return
-            u_token_resign = b64encode(sha256((u_token+get_secret_key()).encode('utf-8')
-                                              ).digest(), altchars=b'-_').decode('utf-8')[:10]
-            if u_signature == u_token_resign:
-                u_username = u_token_dec_str.split(',')[0]
-                u_created_at = int(u_token_dec_str.split(',')[1])
-                return {"username": u_username, "created_at": datetime.utcfromtimestamp(u_created_at)}
-            else:
-                return
-    except jwt.exceptions.PyJWTError:
+            raise ValueError("not a subscription token")
+    else:
+        u_token = token[:-10]
+        u_signature = token[-10:]
+        try:
+            u_token_dec = b64decode(
+                (u_token.encode('utf-8') + b'=' * (-len(u_token.encode('utf-8')) % 4)),
+                altchars=b'-_', validate=True)
+            u_token_dec_str = u_token_dec.decode('utf-8')
+        except:
+            raise ValueError("token is not valid base64")
+        u_token_resign = b64encode(sha256((u_token+get_secret_key()).encode('utf-8')
+                                          ).digest(), altchars=b'-_').decode('utf-8')[:10]
+        if u_signature == u_token_resign:
+            u_username = u_token_dec_str.split(',')[0]
+            u_created_at = int(u_token_dec_str.split(',')[1])
+            return SubscriptionPayload(u_username, datetime.utcfromtimestamp(u_created_at))
+        else:
+            raise ValueError("invalid signature")
+
+
+def get_subscription_payload(token: str) -> Union[SubscriptionPayload, None]:
+    try:
+        return _decode_subscription_token(token)
+    except (ValueError, jwt.exceptions.PyJWTError):
         return
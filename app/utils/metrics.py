@@ -0,0 +1,36 @@
+from collections import defaultdict
+from threading import Lock
+from typing import Dict
+
+
+class Metrics:
+    """
+    Process-wide counters and gauges for the background jobs.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values: Dict[str, float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._values[name] += value
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self._values[name] = value
+
+    def remove(self, name: str):
+        with self._lock:
+            self._values.pop(name, None)
+
+    def get(self, name: str, default: float = 0) -> float:
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+metrics = Metrics()
@@ -28,6 +28,8 @@ api = XRayAPI(config.api_host, config.api_port)
 
 nodes: Dict[int, XRayNode] = {}
 
+from app.xray import reconciler  # noqa
+
 
 if TYPE_CHECKING:
     from app.db.models import ProxyHost
@@ -74,6 +76,7 @@ __all__ = [
     "api",
     "nodes",
     "operations",
+    "reconciler",
     "exceptions",
     "exc",
     "types",
@@ -0,0 +1,162 @@
+"""
+In-memory registry of the inbound clients generated from active and
+on-hold users, kept up to date by the user signals so the core config
+doesn't need a full users query every time it's generated.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+
+from app.db import GetDB, events
+from app.db import models as db_models
+from app.models.user import UserStatus
+
+if TYPE_CHECKING:
+    from app.xray.config import XRayConfig
+
+# (proxy type, settings, excluded inbound tags)
+ProxyRow = Tuple[str, dict, Optional[List[str]]]
+
+
+def supports_flow(inbound: dict) -> bool:
+    """Whether clients of the inbound can use an XTLS flow."""
+    # XTLS currently only supports transmission methods of TCP and mKCP
+    return inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp') \
+        and inbound.get('tls') in ('tls', 'reality') \
+        and inbound.get('header_type') != 'http'
+
+
+def _build_client(inbound: dict, email: str, settings: dict) -> dict:
+    client = {"email": email, **settings}
+
+    if client.get('flow') and not supports_flow(inbound):
+        del client['flow']
+
+    return client
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._lock = Lock()
+        self._loaded = False
+        self._users: Dict[int, Tuple[str, List[ProxyRow]]] = {}
+
+        # clients generated for the base config with this fingerprint
+        self._fingerprint: Optional[str] = None
+        self._base: Optional[XRayConfig] = None
+        self._clients: Dict[int, Dict[str, dict]] = {}
+
+    def _load(self):
+        with GetDB() as db:
+            query = db.query(
+                db_models.User.id,
+                db_models.User.username,
+                func.lower(db_models.Proxy.type).label('type'),
+                db_models.Proxy.settings,
+                func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
+            ).join(
+                db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
+            ).outerjoin(
+                db_models.excluded_inbounds_association,
+                db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
+            ).filter(
+                db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
+            ).group_by(
+                func.lower(db_models.Proxy.type),
+                db_models.User.id,
+                db_models.User.username,
+                db_models.Proxy.settings,
+            )
+            result = query.all()
+
+        users = {}
+        for row in result:
+            excluded_inbound_tags = [i for i in row.excluded_inbound_tags.split(',') if i] \
+                if row.excluded_inbound_tags else None
+            users.setdefault(row.id, (row.username, []))[1].append((row.type, row.settings, excluded_inbound_tags))
+
+        self._users = users
+        self._fingerprint = None
+        self._clients = {}
+        self._loaded = True
+
+    def _build_user(self, base: XRayConfig, user_id: int) -> Dict[str, dict]:
+        username, proxies = self._users[user_id]
+        email = f"{user_id}.{username}"
+
+        clients = {}
+        for proxy_type, settings, excluded_inbound_tags in proxies:
+            for inbound in base.inbounds_by_protocol.get(proxy_type, []):
+                if excluded_inbound_tags and inbound['tag'] in excluded_inbound_tags:
+                    continue
+                clients[inbound['tag']] = _build_client(inbound, email, settings)
+        return clients
+
+    def get(self, base: XRayConfig) -> Dict[str, List[dict]]:
+        """
+        Returns the clients of every inbound of the base config.
+        """
+        fingerprint = base.structure_fingerprint()
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+            if fingerprint != self._fingerprint:
+                self._clients = {user_id: self._build_user(base, user_id) for user_id in self._users}
+                self._fingerprint = fingerprint
+                self._base = base
+
+            inbounds = defaultdict(list)
+            for clients in self._clients.values():
+                for inbound_tag, client in clients.items():
+                    inbounds[inbound_tag].append(client)
+            return inbounds
+
+    def update(self, dbuser: db_models.User):
+        if dbuser.status not in (UserStatus.active, UserStatus.on_hold):
+            return self.remove(dbuser.id)
+
+        proxies = [
+            (proxy.type.value.lower(), proxy.settings, [i.tag for i in proxy.excluded_inbounds] or None)
+            for proxy in dbuser.proxies
+        ]
+        with self._lock:
+            if not self._loaded:
+                return
+
+            self._users[dbuser.id] = (dbuser.username, proxies)
+            self._clients.pop(dbuser.id, None)
+            if self._fingerprint is not None:
+                self._clients[dbuser.id] = self._build_user(self._base, dbuser.id)
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._clients.pop(user_id, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+
+registry = ClientRegistry()
+
+
+@events.user_updated.connect
+def _on_user_updated(dbuser: db_models.User):
+    registry.update(dbuser)
+
+
+@events.user_removed.connect
+def _on_user_removed(dbuser: db_models.User):
+    registry.remove(dbuser.id)
+
+
+@events.users_updated.connect
+def _on_users_updated():
+    registry.invalidate()
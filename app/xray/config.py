@@ -1,20 +1,17 @@
 from __future__ import annotations
 
+import hashlib
 import json
-from collections import defaultdict
-from copy import deepcopy
+from copy import copy, deepcopy
 from pathlib import PosixPath
-from typing import Union
+from typing import Dict, Iterator, Tuple, Union
 
 import commentjson
-from sqlalchemy import func
-
-from app.db import GetDB
-from app.db import models as db_models
 from app.models.proxy import ProxyTypes
-from app.models.user import UserStatus
 from app.utils.crypto import get_cert_SANs
 from config import DEBUG, XRAY_EXCLUDE_INBOUND_TAGS, XRAY_FALLBACKS_INBOUND_TAG
+from app.xray.clients import registry as client_registry
+from xray_api.types.account import Account
 
 
 def merge_dicts(a, b):  # B will override A dictionary key and values
@@ -49,6 +46,7 @@ class XRayConfig(dict):
 
         self.api_host = api_host
         self.api_port = api_port
+        self.fingerprint = None  # structure fingerprint of the base config, set on generated configs
 
         super().__init__(config)
         self._validate()
@@ -352,82 +350,63 @@ class XRayConfig(dict):
             if outbound['tag'] == tag:
                 return outbound
 
+    def structure_fingerprint(self) -> str:
+        """
+        Hash of the config without the inbounds' clients, clients can be
+        changed through the API while the rest needs a restart of the core.
+        """
+        inbounds = [
+            {**inbound, "settings": {k: v for k, v in (inbound.get("settings") or {}).items() if k != "clients"}}
+            for inbound in self.get("inbounds", [])
+        ]
+        data = json.dumps({**self, "inbounds": inbounds}, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get_clients(self) -> Dict[Tuple[str, str], Account]:
+        """Accounts of the inbounds' clients, keyed by (inbound tag, email)."""
+        clients = {}
+        for inbound in self.get("inbounds", []):
+            try:
+                proxy_type = ProxyTypes(inbound.get("protocol"))
+            except ValueError:
+                continue
+            for client in (inbound.get("settings") or {}).get("clients") or []:
+                if client.get("email"):
+                    clients[(inbound["tag"], client["email"])] = proxy_type.account_model(**client)
+        return clients
+
     def to_json(self, **json_kwargs):
         return json.dumps(self, **json_kwargs)
 
-    def copy(self):
-        return deepcopy(self)
+    def iter_json(self, **json_kwargs) -> Iterator[str]:
+        """Encodes the config in chunks, without building the whole string."""
+        return json.JSONEncoder(**json_kwargs).iterencode(self)
+
+    def copy(self) -> XRayConfig:
+        """
+        Structural copy: sections are shared with this config, only the
+        inbounds and their settings and clients lists are new objects.
+        Shared sections must be replaced rather than modified in place.
+        """
+        config = copy(self)
+        inbounds = []
+        for inbound in self.get("inbounds", []):
+            inbound = dict(inbound)
+            settings = inbound.get("settings")
+            if isinstance(settings, dict):
+                inbound["settings"] = settings = dict(settings)
+                if "clients" in settings:
+                    settings["clients"] = list(settings["clients"] or [])
+            inbounds.append(inbound)
+        config["inbounds"] = inbounds
+        return config
 
     def include_db_users(self) -> XRayConfig:
         config = self.copy()
+        config.fingerprint = self.structure_fingerprint()
 
-        with GetDB() as db:
-            query = db.query(
-                db_models.User.id,
-                db_models.User.username,
-                func.lower(db_models.Proxy.type).label('type'),
-                db_models.Proxy.settings,
-                func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
-            ).join(
-                db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
-            ).outerjoin(
-                db_models.excluded_inbounds_association,
-                db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
-            ).filter(
-                db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
-            ).group_by(
-                func.lower(db_models.Proxy.type),
-                db_models.User.id,
-                db_models.User.username,
-                db_models.Proxy.settings,
-            )
-            result = query.all()
-
-            grouped_data = defaultdict(list)
-
-            for row in result:
-                grouped_data[row.type].append((
-                    row.id,
-                    row.username,
-                    row.settings,
-                    [i for i in row.excluded_inbound_tags.split(',') if i] if row.excluded_inbound_tags else None
-                ))
-
-            for proxy_type, rows in grouped_data.items():
-
-                inbounds = self.inbounds_by_protocol.get(proxy_type)
-                if not inbounds:
-                    continue
-
-                for inbound in inbounds:
-                    clients = config.get_inbound(inbound['tag'])['settings']['clients']
-
-                    for row in rows:
-                        user_id, username, settings, excluded_inbound_tags = row
-
-                        if excluded_inbound_tags and inbound['tag'] in excluded_inbound_tags:
-                            continue
-
-                        client = {
-                            "email": f"{user_id}.{username}",
-                            **settings
-                        }
-
-                        # XTLS currently only supports transmission methods of TCP and mKCP
-                        if client.get('flow') and (
-                                inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
-                                or
-                                (
-                                    inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
-                                    and
-                                    inbound.get('tls') not in ('tls', 'reality')
-                                )
-                                or
-                                inbound.get('header_type') == 'http'
-                        ):
-                            del client['flow']
-
-                        clients.append(client)
+        for inbound_tag, clients in client_registry.get(self).items():
+            config.get_inbound(inbound_tag)['settings']['clients'].extend(clients)
 
         if DEBUG:
             with open('generated_config-debug.json', 'w') as f:
@@ -20,6 +20,7 @@ class XRayCore:
         self.version = self.get_version()
         self.process = None
         self.restarting = False
+        self.config = None
 
         self._logs_buffer = deque(maxlen=100)
         self._temp_log_buffers = {}
@@ -108,7 +109,7 @@ class XRayCore:
             raise RuntimeError("Xray is started already")
 
         if config.get('log', {}).get('logLevel') in ('none', 'error'):
-            config['log']['logLevel'] = 'warning'
+            config['log'] = {**config['log'], 'logLevel': 'warning'}
 
         cmd = [
             self.executable_path,
@@ -124,9 +125,11 @@ class XRayCore:
             stdout=subprocess.PIPE,
             universal_newlines=True
         )
-        self.process.stdin.write(config.to_json())
+        for chunk in config.iter_json():
+            self.process.stdin.write(chunk)
         self.process.stdin.flush()
         self.process.stdin.close()
+        self.config = config
         logger.warning(f"Xray core {self.version} started")
 
         self.__capture_process_logs()
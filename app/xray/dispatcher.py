@@ -0,0 +1,243 @@
+"""
+Per-core queues of user provisioning operations.
+
+Operations waiting for the same inbound and email are coalesced, and every
+queue is drained in batches by a bounded pool of workers, so bulk user
+changes don't start a thread per inbound and node.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+from typing import Dict, List, Optional, Tuple
+
+from app import logger, xray
+from app.utils.metrics import metrics
+from app.xray.config import XRayConfig
+from config import XRAY_OPERATIONS_BATCH_SIZE, XRAY_OPERATIONS_QUEUE_SIZE, XRAY_OPERATIONS_WORKERS
+from xray_api import XRay as XRayAPI
+from xray_api.types.account import Account
+
+ADD = 'add'
+REMOVE = 'remove'
+ALTER = 'alter'  # remove, then add again
+
+Operation = Tuple[str, Optional[Account]]
+
+
+def _coalesce(prev: Optional[Operation], op: Operation) -> Operation:
+    if prev is None or op[0] == REMOVE:
+        return op
+    if op[0] == ADD and prev[0] == ADD:
+        return op
+    return (ALTER, op[1])
+
+
+class OperationQueue:
+    def __init__(self, node_id: Optional[int], max_size: int):
+        self.node_id = node_id
+        self.name = 'core' if node_id is None else f'node_{node_id}'
+        self.max_size = max_size
+        self.scheduled = False
+        self._cond = Condition()
+        self._ops: Dict[Tuple[str, str], Operation] = OrderedDict()
+
+        # what the core is known to run, for the reconciler
+        self.fingerprint: Optional[str] = None
+        self.clients: Dict[Tuple[str, str], Account] = {}
+        # operations were lost while the core was unreachable
+        self.stale = False
+
+    def __len__(self):
+        return len(self._ops)
+
+    def put(self, inbound_tag: str, email: str, op: Operation) -> bool:
+        """
+        Queues the operation, blocking while the queue is full.
+
+        Returns:
+            bool: Whether the queue has to be scheduled for draining.
+        """
+        key = (inbound_tag, email)
+        with self._cond:
+            while key not in self._ops and len(self._ops) >= self.max_size:
+                self._cond.wait()
+
+            prev = self._ops.get(key)
+            if prev is not None:
+                metrics.inc("xray_operations_coalesced")
+            self._ops[key] = _coalesce(prev, op)
+            metrics.set(f"xray_operations_queue_depth.{self.name}", len(self._ops))
+
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def applied(self, inbound_tag: str, email: str, account: Optional[Account]):
+        with self._cond:
+            if account is None:
+                self.clients.pop((inbound_tag, email), None)
+            else:
+                self.clients[(inbound_tag, email)] = account
+
+    def take(self, count: int) -> List[Tuple[Tuple[str, str], Operation]]:
+        with self._cond:
+            batch = []
+            while self._ops and len(batch) < count:
+                batch.append(self._ops.popitem(last=False))
+            if not batch:
+                self.scheduled = False
+            metrics.set(f"xray_operations_queue_depth.{self.name}", len(self._ops))
+            self._cond.notify_all()
+            return batch
+
+
+class OperationDispatcher:
+    def __init__(self, workers: int, batch_size: int, max_size: int):
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self._lock = Lock()
+        self._queues: Dict[Optional[int], OperationQueue] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xray-operations")
+
+    def _get_queue(self, node_id: Optional[int]) -> OperationQueue:
+        with self._lock:
+            queue = self._queues.get(node_id)
+            if queue is None:
+                queue = self._queues[node_id] = OperationQueue(node_id, self.max_size)
+            return queue
+
+    def put(self, node_id: Optional[int], inbound_tag: str, email: str, op: str, account: Account = None):
+        """
+        Queues an operation for the main core (node_id=None) or a node.
+        """
+        queue = self._get_queue(node_id)
+        if queue.put(inbound_tag, email, (op, account)):
+            self._executor.submit(self._drain, queue)
+
+    def reset(self, node_id: Optional[int], config: XRayConfig,
+              clients: Optional[Dict[Tuple[str, str], Account]] = None):
+        """
+        Records the config the core was (re)started with, clients can be
+        passed when they were already built from the config for other cores.
+        """
+        queue = self._get_queue(node_id)
+        clients = dict(clients) if clients is not None else config.get_clients()
+        with queue._cond:
+            queue.fingerprint = config.fingerprint
+            queue.clients = clients
+            queue.stale = False
+
+    def remove(self, node_id: int):
+        """
+        Drops the queue and the known state of a removed node.
+        """
+        with self._lock:
+            queue = self._queues.pop(node_id, None)
+        if queue is None:
+            return
+
+        with queue._cond:
+            dropped = len(queue._ops)
+            queue._ops.clear()
+            queue.clients = {}
+            queue._cond.notify_all()
+        metrics.remove(f"xray_operations_queue_depth.{queue.name}")
+        if dropped:
+            metrics.inc("xray_operations_dropped", dropped)
+            logger.info(f"Dropped {dropped} pending operations of removed {queue.name}")
+
+    def state(self, node_id: Optional[int]) -> Tuple[Optional[str], Dict[Tuple[str, str], Account]]:
+        """
+        Returns the structure fingerprint and the clients the core is known to run.
+        """
+        queue = self._get_queue(node_id)
+        with queue._cond:
+            return queue.fingerprint, dict(queue.clients)
+
+    def stale(self) -> List[Optional[int]]:
+        """
+        Returns the cores (None for the main core) which lost operations while they were unreachable.
+        """
+        with self._lock:
+            return [node_id for node_id, queue in self._queues.items() if queue.stale]
+
+    def clear_stale(self, node_id: Optional[int]):
+        queue = self._get_queue(node_id)
+        with queue._cond:
+            queue.stale = False
+
+    def depths(self) -> Dict[str, int]:
+        with self._lock:
+            return {queue.name: len(queue) for queue in self._queues.values()}
+
+    @staticmethod
+    def _get_api(node_id: Optional[int]) -> Optional[XRayAPI]:
+        if node_id is None:
+            return xray.api
+
+        node = xray.nodes.get(node_id)
+        try:
+            if node and node.connected and node.started:
+                return node.api
+        except Exception:
+            pass
+
+    @staticmethod
+    def _invalidate(node_id: Optional[int]):
+        node = xray.nodes.get(node_id) if node_id is not None else None
+        if node is not None:
+            node.invalidate_state()
+
+    def _apply(self, api: XRayAPI, queue: OperationQueue, inbound_tag: str, email: str, op: Operation):
+        action, account = op
+        if action in (REMOVE, ALTER):
+            try:
+                api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
+                queue.applied(inbound_tag, email, None)
+            except xray.exc.EmailNotFoundError:
+                queue.applied(inbound_tag, email, None)
+            except xray.exc.ConnectionError:
+                queue.stale = True
+                self._invalidate(queue.node_id)
+        if action in (ADD, ALTER):
+            try:
+                api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
+                queue.applied(inbound_tag, email, account)
+            except xray.exc.EmailExistsError:
+                queue.applied(inbound_tag, email, account)
+            except xray.exc.ConnectionError:
+                queue.stale = True
+                self._invalidate(queue.node_id)
+
+    def _drain(self, queue: OperationQueue):
+        batch = queue.take(self.batch_size)
+        if not batch:
+            return
+
+        try:
+            api = self._get_api(queue.node_id)
+            if api is None:
+                # the known clients still lack these operations, the core health check
+                # reconciles the queue's core once it's reachable again, or restarts it
+                queue.stale = True
+                metrics.inc("xray_operations_dropped", len(batch))
+                logger.warning(f"Dropped {len(batch)} operations of {queue.name}, its API is unavailable")
+            else:
+                for (inbound_tag, email), op in batch:
+                    try:
+                        self._apply(api, queue, inbound_tag, email, op)
+                    except Exception as e:
+                        metrics.inc("xray_operations_failed")
+                        logger.warning(f"Unable to {op[0]} user \"{email}\" on {queue.name} ({inbound_tag}): {e}")
+        finally:
+            # one batch per turn, so a busy queue doesn't starve the others
+            self._executor.submit(self._drain, queue)
+
+
+dispatcher = OperationDispatcher(
+    workers=XRAY_OPERATIONS_WORKERS,
+    batch_size=XRAY_OPERATIONS_BATCH_SIZE,
+    max_size=XRAY_OPERATIONS_QUEUE_SIZE
+)
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import socket
 import re
 import ssl
@@ -9,6 +11,7 @@ from contextlib import contextmanager
 from typing import List
 
 import grpc
+import httpx
 import requests
 import rpyc
 from requests.adapters import HTTPAdapter
@@ -16,6 +19,7 @@ from requests.packages.urllib3.poolmanager import PoolManager
 from websocket import WebSocketConnectionClosedException, WebSocketTimeoutException, create_connection
 
 from app.xray.config import XRayConfig
+from config import NODE_HEARTBEAT_INTERVAL
 from xray_api import XRay as XRayAPI
 
 
@@ -77,11 +81,28 @@ class ReSTXRayNode:
         self._api = None
         self._started = False
 
+        # (connected, started), refreshed by the heartbeat thread
+        self._state = None
+        self._heartbeat_thread = None
+
+        # client of the async requests, bound to the event loop it was created in
+        self._async_ssl_context = None
+        self._async_client = None
+        self._async_client_loop = None
+
     def _prepare_config(self, config: XRayConfig):
+        # sections are shared with the base config, copy the path before inlining certificates
+        config = config.copy()
         for inbound in config.get("inbounds", []):
             streamSettings = inbound.get("streamSettings") or {}
             tlsSettings = streamSettings.get("tlsSettings") or {}
             certificates = tlsSettings.get("certificates") or []
+            if not certificates:
+                continue
+
+            inbound["streamSettings"] = streamSettings = dict(streamSettings)
+            streamSettings["tlsSettings"] = tlsSettings = dict(tlsSettings)
+            tlsSettings["certificates"] = certificates = [dict(certificate) for certificate in certificates]
             for certificate in certificates:
                 if certificate.get("certificateFile"):
                     with open(certificate['certificateFile']) as file:
@@ -105,6 +126,7 @@ class ReSTXRayNode:
                                     json={"session_id": self._session_id, **params})
             data = res.json()
         except Exception as e:
+            self._state = None
             exc = NodeAPIError(0, str(e))
             raise exc
 
@@ -114,20 +136,73 @@ class ReSTXRayNode:
             exc = NodeAPIError(res.status_code, data['detail'])
             raise exc
 
-    @property
-    def connected(self):
+    def _config_body(self, config: XRayConfig):
+        yield f'{{"session_id": {json.dumps(self._session_id)}, "config": "'.encode()
+        for chunk in config.iter_json():
+            yield json.dumps(chunk)[1:-1].encode()
+        yield b'"}'
+
+    def make_config_request(self, path: str, timeout: int, config: XRayConfig):
+        """
+        Sends the config as the "config" string of the request body,
+        encoding it while the body is streamed.
+        """
+        try:
+            res = self.session.post(self._rest_api_url + path, timeout=timeout,
+                                    data=self._config_body(config),
+                                    headers={"Content-Type": "application/json"})
+            data = res.json()
+        except Exception as e:
+            self._state = None
+            exc = NodeAPIError(0, str(e))
+            raise exc
+
+        if res.status_code == 200:
+            return data
+        else:
+            exc = NodeAPIError(res.status_code, data['detail'])
+            raise exc
+
+    def _probe(self):
         if not self._session_id:
-            return False
+            return (False, False)
         try:
             self.make_request("/ping", timeout=3)
-            return True
         except NodeAPIError:
-            return False
+            return (False, False)
+        try:
+            res = self.make_request("/", timeout=3)
+        except NodeAPIError:
+            return (True, False)
+        return (True, res.get('started', False))
+
+    def _get_state(self):
+        state = self._state
+        if state is None:
+            state = self._state = self._probe()
+        return state
+
+    def _heartbeat(self):
+        while self._session_id:
+            self._state = self._probe()
+            time.sleep(NODE_HEARTBEAT_INTERVAL)
+
+    def _start_heartbeat(self):
+        if self._heartbeat_thread is None or not self._heartbeat_thread.is_alive():
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+            self._heartbeat_thread.start()
+
+    def invalidate_state(self):
+        """Drops the cached state, the next read probes the node."""
+        self._state = None
+
+    @property
+    def connected(self):
+        return self._get_state()[0]
 
     @property
     def started(self):
-        res = self.make_request("/", timeout=3)
-        return res.get('started', False)
+        return self._get_state()[1]
 
     @property
     def api(self):
@@ -149,15 +224,23 @@ class ReSTXRayNode:
 
     def connect(self):
         self._node_cert = ssl.get_server_certificate((self.address, self.port))
-        self._node_certfile = string_to_temp_file(self._node_cert)
-        self.session.verify = self._node_certfile.name
+        self._close_async_client()
+        self._async_ssl_context = self._load_node_cert(self._node_cert)
 
         res = self.make_request("/connect", timeout=3)
         self._session_id = res['session_id']
+        self._state = None
+        self._start_heartbeat()
 
     def disconnect(self):
-        self.make_request("/disconnect", timeout=3)
-        self._session_id = None
+        self._state = None
+        self._close_async_client()
+        try:
+            self.make_request("/disconnect", timeout=3)
+        finally:
+            # also stops the heartbeat of an unreachable node
+            self._session_id = None
+            self._state = None
 
     def get_version(self):
         res = self.make_request("/", timeout=3)
@@ -168,10 +251,9 @@ class ReSTXRayNode:
             self.connect()
 
         config = self._prepare_config(config)
-        json_config = config.to_json()
 
         try:
-            res = self.make_request("/start", timeout=10, config=json_config)
+            res = self.make_config_request("/start", timeout=10, config=config)
         except NodeAPIError as exc:
             if exc.detail == 'Xray is started already':
                 return self.restart(config)
@@ -179,6 +261,7 @@ class ReSTXRayNode:
                 raise exc
 
         self._started = True
+        self._state = (True, True)
 
         self._api = XRayAPI(
             address=self.address,
@@ -201,17 +284,18 @@ class ReSTXRayNode:
         self.make_request('/stop', timeout=5)
         self._api = None
         self._started = False
+        self._state = (True, False)
 
     def restart(self, config: XRayConfig):
         if not self.connected:
             self.connect()
 
         config = self._prepare_config(config)
-        json_config = config.to_json()
 
-        res = self.make_request("/restart", timeout=10, config=json_config)
+        res = self.make_config_request("/restart", timeout=10, config=config)
 
         self._started = True
+        self._state = (True, True)
 
         self._api = XRayAPI(
             address=self.address,
@@ -227,6 +311,138 @@ class ReSTXRayNode:
 
         return res
 
+    def _load_node_cert(self, node_cert: str) -> ssl.SSLContext:
+        """Trusts the certificate of the node, returns the SSL context of the async requests."""
+        self._node_certfile = string_to_temp_file(node_cert)
+        self.session.verify = self._node_certfile.name
+
+        ssl_context = ssl.create_default_context(cafile=self._node_certfile.name)
+        ssl_context.check_hostname = False
+        ssl_context.load_cert_chain(certfile=self._certfile.name, keyfile=self._keyfile.name)
+        return ssl_context
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        # connections of a client can't outlive its event loop, every asyncio.run() gets its own client
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = httpx.AsyncClient(verify=self._async_ssl_context)
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _close_async_client(self):
+        client, loop = self._async_client, self._async_client_loop
+        self._async_client = self._async_client_loop = None
+        if client is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            loop.create_task(client.aclose())
+        else:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    async def _post_async(self, path: str, timeout: int, **kwargs):
+        try:
+            client = self._get_async_client()
+            res = await client.post(self._rest_api_url + path, timeout=timeout, **kwargs)
+            data = res.json()
+        except Exception as e:
+            self._state = None
+            exc = NodeAPIError(0, str(e))
+            raise exc
+
+        if res.status_code == 200:
+            return data
+        else:
+            exc = NodeAPIError(res.status_code, data['detail'])
+            raise exc
+
+    async def make_request_async(self, path: str, timeout: int, **params):
+        return await self._post_async(path, timeout, json={"session_id": self._session_id, **params})
+
+    def _config_payload(self, config: XRayConfig) -> bytes:
+        return b"".join(self._config_body(self._prepare_config(config)))
+
+    async def make_config_request_async(self, path: str, timeout: int, config: XRayConfig):
+        # inlining the certificates and encoding a config of many users would block the event loop
+        content = await asyncio.to_thread(self._config_payload, config)
+        return await self._post_async(path, timeout, content=content,
+                                      headers={"Content-Type": "application/json"})
+
+    async def _get_server_certificate_async(self) -> str:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port, ssl=ssl_context), timeout=5
+        )
+        try:
+            der = writer.get_extra_info('ssl_object').getpeercert(binary_form=True)
+        finally:
+            writer.close()
+        return ssl.DER_cert_to_PEM_cert(der)
+
+    async def _wait_api_ready_async(self):
+        credentials = grpc.ssl_channel_credentials(root_certificates=self._node_cert.encode())
+        options = (('grpc.ssl_target_name_override', "Gozargah"),)
+        async with grpc.aio.secure_channel(f"{self.address}:{self.api_port}", credentials, options=options) as channel:
+            try:
+                await asyncio.wait_for(channel.channel_ready(), timeout=5)
+            except asyncio.TimeoutError:
+                raise ConnectionError('Failed to connect to node\'s API')
+
+    async def connect_async(self):
+        self._node_cert = await self._get_server_certificate_async()
+        self._close_async_client()
+        self._async_ssl_context = await asyncio.to_thread(self._load_node_cert, self._node_cert)
+
+        res = await self.make_request_async("/connect", timeout=3)
+        self._session_id = res['session_id']
+        self._state = None
+        self._start_heartbeat()
+
+    async def get_version_async(self):
+        res = await self.make_request_async("/", timeout=3)
+        return res.get('core_version')
+
+    async def start_async(self, config: XRayConfig):
+        if not self._session_id:
+            await self.connect_async()
+
+        try:
+            res = await self.make_config_request_async("/start", timeout=10, config=config)
+        except NodeAPIError as exc:
+            if exc.detail == 'Xray is started already':
+                return await self.restart_async(config)
+            else:
+                raise exc
+
+        return await self._on_started_async(res)
+
+    async def restart_async(self, config: XRayConfig):
+        if not self._session_id:
+            await self.connect_async()
+
+        res = await self.make_config_request_async("/restart", timeout=10, config=config)
+
+        return await self._on_started_async(res)
+
+    async def _on_started_async(self, res):
+        self._started = True
+        self._state = (True, True)
+
+        self._api = XRayAPI(
+            address=self.address,
+            port=self.api_port,
+            ssl_cert=self._node_cert.encode(),
+            ssl_target_name="Gozargah"
+        )
+        await self._wait_api_ready_async()
+
+        return res
+
     def _bg_fetch_logs(self):
         while self._logs_queues:
             try:
@@ -353,6 +569,10 @@ class RPyCXRayNode:
                     continue
                 raise exc
 
+    def invalidate_state(self):
+        # state isn't cached, connected pings the open rpyc connection
+        pass
+
     @property
     def connected(self):
         try:
@@ -382,10 +602,18 @@ class RPyCXRayNode:
         return self.remote.fetch_xray_version()
 
     def _prepare_config(self, config: XRayConfig):
+        # sections are shared with the base config, copy the path before inlining certificates
+        config = config.copy()
         for inbound in config.get("inbounds", []):
             streamSettings = inbound.get("streamSettings") or {}
             tlsSettings = streamSettings.get("tlsSettings") or {}
             certificates = tlsSettings.get("certificates") or []
+            if not certificates:
+                continue
+
+            inbound["streamSettings"] = streamSettings = dict(streamSettings)
+            streamSettings["tlsSettings"] = tlsSettings = dict(tlsSettings)
+            tlsSettings["certificates"] = certificates = [dict(certificate) for certificate in certificates]
             for certificate in certificates:
                 if certificate.get("certificateFile"):
                     with open(certificate['certificateFile']) as file:
@@ -448,6 +676,19 @@ class RPyCXRayNode:
         self.remote.restart(json_config)
         self.started = True
 
+    # rpyc has no asyncio support, the blocking calls run in the default executor
+    async def connect_async(self):
+        await asyncio.to_thread(self.connect)
+
+    async def get_version_async(self):
+        return await asyncio.to_thread(self.get_version)
+
+    async def start_async(self, config: XRayConfig):
+        return await asyncio.to_thread(self.start, config)
+
+    async def restart_async(self, config: XRayConfig):
+        return await asyncio.to_thread(self.restart, config)
+
     @contextmanager
     def get_logs(self):
         if not self.connected:
@@ -1,5 +1,6 @@
+import asyncio
 from functools import lru_cache
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -8,8 +9,9 @@ from app.db import GetDB, crud
 from app.models.node import NodeStatus
 from app.models.user import UserResponse
 from app.utils.concurrency import threaded_function
+from app.xray.clients import supports_flow
+from app.xray.dispatcher import ADD, ALTER, REMOVE, dispatcher
 from app.xray.node import XRayNode
-from xray_api import XRay as XRayAPI
 from xray_api.types.account import Account, XTLSFlows
 
 if TYPE_CHECKING:
@@ -28,32 +30,10 @@ def get_tls():
         }
 
 
-@threaded_function
-def _add_user_to_inbound(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
-
-
-@threaded_function
-def _remove_user_from_inbound(api: XRayAPI, inbound_tag: str, email: str):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
-
-
-@threaded_function
-def _alter_inbound_user(api: XRayAPI, inbound_tag: str, account: Account):
-    try:
-        api.remove_inbound_user(tag=inbound_tag, email=account.email, timeout=30)
-    except (xray.exc.EmailNotFoundError, xray.exc.ConnectionError):
-        pass
-    try:
-        api.add_inbound_user(tag=inbound_tag, user=account, timeout=30)
-    except (xray.exc.EmailExistsError, xray.exc.ConnectionError):
-        pass
+def _queue(inbound_tag: str, email: str, op: str, account: Account = None):
+    dispatcher.put(None, inbound_tag, email, op, account)  # main core
+    for node_id in list(xray.nodes):
+        dispatcher.put(node_id, inbound_tag, email, op, account)
 
 
 def add_user(dbuser: "DBUser"):
@@ -70,34 +50,17 @@ def add_user(dbuser: "DBUser"):
                 pass
             account = proxy_type.account_model(email=email, **proxy_settings)
 
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, 'flow', None) and (
-                inbound.get('network', 'tcp') not in ('tcp', 'kcp')
-                or
-                (
-                    inbound.get('network', 'tcp') in ('tcp', 'kcp')
-                    and
-                    inbound.get('tls') not in ('tls', 'reality')
-                )
-                or
-                inbound.get('header_type') == 'http'
-            ):
+            if getattr(account, 'flow', None) and not supports_flow(inbound):
                 account.flow = XTLSFlows.NONE
 
-            _add_user_to_inbound(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
-                if node.connected and node.started:
-                    _add_user_to_inbound(node.api, inbound_tag, account)
+            _queue(inbound_tag, email, ADD, account)
 
 
 def remove_user(dbuser: "DBUser"):
     email = f"{dbuser.id}.{dbuser.username}"
 
     for inbound_tag in xray.config.inbounds_by_tag:
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
-            if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+        _queue(inbound_tag, email, REMOVE)
 
 
 def update_user(dbuser: "DBUser"):
@@ -116,36 +79,20 @@ def update_user(dbuser: "DBUser"):
                 pass
             account = proxy_type.account_model(email=email, **proxy_settings)
 
-            # XTLS currently only supports transmission methods of TCP and mKCP
-            if getattr(account, 'flow', None) and (
-                inbound.get('network', 'tcp') not in ('tcp', 'kcp')
-                or
-                (
-                    inbound.get('network', 'tcp') in ('tcp', 'kcp')
-                    and
-                    inbound.get('tls') not in ('tls', 'reality')
-                )
-                or
-                inbound.get('header_type') == 'http'
-            ):
+            if getattr(account, 'flow', None) and not supports_flow(inbound):
                 account.flow = XTLSFlows.NONE
 
-            _alter_inbound_user(xray.api, inbound_tag, account)  # main core
-            for node in list(xray.nodes.values()):
-                if node.connected and node.started:
-                    _alter_inbound_user(node.api, inbound_tag, account)
+            _queue(inbound_tag, email, ALTER, account)
 
     for inbound_tag in xray.config.inbounds_by_tag:
         if inbound_tag in active_inbounds:
             continue
         # remove disabled inbounds
-        _remove_user_from_inbound(xray.api, inbound_tag, email)
-        for node in list(xray.nodes.values()):
-            if node.connected and node.started:
-                _remove_user_from_inbound(node.api, inbound_tag, email)
+        _queue(inbound_tag, email, REMOVE)
 
 
 def remove_node(node_id: int):
+    dispatcher.remove(node_id)
     if node_id in xray.nodes:
         try:
             xray.nodes[node_id].disconnect()
@@ -192,41 +139,45 @@ global _connecting_nodes
 _connecting_nodes = {}
 
 
-@threaded_function
-def connect_node(node_id, config=None):
+def _get_dbnode(node_id: int):
+    with GetDB() as db:
+        return crud.get_node_by_id(db, node_id)
+
+
+async def connect_node_async(node_id, config=None, clients=None):
     global _connecting_nodes
 
     if _connecting_nodes.get(node_id):
         return
 
-    with GetDB() as db:
-        dbnode = crud.get_node_by_id(db, node_id)
+    dbnode = await asyncio.to_thread(_get_dbnode, node_id)
 
     if not dbnode:
         return
 
     try:
         node = xray.nodes[dbnode.id]
-        assert node.connected
+        assert await asyncio.to_thread(lambda: node.connected)
     except (KeyError, AssertionError):
-        node = xray.operations.add_node(dbnode)
+        node = await asyncio.to_thread(add_node, dbnode)
 
     try:
         _connecting_nodes[node_id] = True
 
-        _change_node_status(node_id, NodeStatus.connecting)
+        await asyncio.to_thread(_change_node_status, node_id, NodeStatus.connecting)
         logger.info(f"Connecting to \"{dbnode.name}\" node")
 
         if config is None:
-            config = xray.config.include_db_users()
+            config = await asyncio.to_thread(xray.config.include_db_users)
 
-        node.start(config)
-        version = node.get_version()
-        _change_node_status(node_id, NodeStatus.connected, version=version)
+        await node.start_async(config)
+        await asyncio.to_thread(dispatcher.reset, node_id, config, clients)
+        version = await node.get_version_async()
+        await asyncio.to_thread(_change_node_status, node_id, NodeStatus.connected, version=version)
         logger.info(f"Connected to \"{dbnode.name}\" node, xray run on v{version}")
 
     except Exception as e:
-        _change_node_status(node_id, NodeStatus.error, message=str(e))
+        await asyncio.to_thread(_change_node_status, node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to connect to \"{dbnode.name}\" node")
 
     finally:
@@ -236,10 +187,8 @@ def connect_node(node_id, config=None):
             pass
 
 
-@threaded_function
-def restart_node(node_id, config=None):
-    with GetDB() as db:
-        dbnode = crud.get_node_by_id(db, node_id)
+async def restart_node_async(node_id, config=None, clients=None):
+    dbnode = await asyncio.to_thread(_get_dbnode, node_id)
 
     if not dbnode:
         return
@@ -247,28 +196,69 @@ def restart_node(node_id, config=None):
     try:
         node = xray.nodes[dbnode.id]
     except KeyError:
-        node = xray.operations.add_node(dbnode)
+        node = await asyncio.to_thread(add_node, dbnode)
 
-    if not node.connected:
-        return connect_node(node_id, config)
+    if not await asyncio.to_thread(lambda: node.connected):
+        return await connect_node_async(node_id, config, clients)
 
     try:
         logger.info(f"Restarting Xray core of \"{dbnode.name}\" node")
 
         if config is None:
-            config = xray.config.include_db_users()
+            config = await asyncio.to_thread(xray.config.include_db_users)
 
-        node.restart(config)
+        await node.restart_async(config)
+        await asyncio.to_thread(dispatcher.reset, node_id, config, clients)
         logger.info(f"Xray core of \"{dbnode.name}\" node restarted")
     except Exception as e:
-        _change_node_status(node_id, NodeStatus.error, message=str(e))
+        await asyncio.to_thread(_change_node_status, node_id, NodeStatus.error, message=str(e))
         logger.info(f"Unable to restart node {node_id}")
         try:
-            node.disconnect()
+            await asyncio.to_thread(node.disconnect)
         except Exception:
             pass
 
 
+async def connect_nodes_async(node_ids: List[int], config=None):
+    """Connects the nodes concurrently, it takes about as long as the slowest node."""
+    if not node_ids:
+        return
+    if config is None:
+        config = await asyncio.to_thread(xray.config.include_db_users)
+    clients = await asyncio.to_thread(config.get_clients)  # built once for all the nodes
+    await asyncio.gather(*(connect_node_async(node_id, config, clients) for node_id in node_ids))
+
+
+async def restart_nodes_async(node_ids: List[int], config=None):
+    """Restarts the nodes concurrently, it takes about as long as the slowest node."""
+    if not node_ids:
+        return
+    if config is None:
+        config = await asyncio.to_thread(xray.config.include_db_users)
+    clients = await asyncio.to_thread(config.get_clients)  # built once for all the nodes
+    await asyncio.gather(*(restart_node_async(node_id, config, clients) for node_id in node_ids))
+
+
+@threaded_function
+def connect_node(node_id, config=None):
+    asyncio.run(connect_node_async(node_id, config))
+
+
+@threaded_function
+def restart_node(node_id, config=None):
+    asyncio.run(restart_node_async(node_id, config))
+
+
+@threaded_function
+def connect_nodes(node_ids: List[int], config=None):
+    asyncio.run(connect_nodes_async(node_ids, config))
+
+
+@threaded_function
+def restart_nodes(node_ids: List[int], config=None):
+    asyncio.run(restart_nodes_async(node_ids, config))
+
+
 __all__ = [
     "add_user",
     "remove_user",
@@ -276,4 +266,10 @@ __all__ = [
     "remove_node",
     "connect_node",
     "restart_node",
+    "connect_nodes",
+    "restart_nodes",
+    "connect_node_async",
+    "restart_node_async",
+    "connect_nodes_async",
+    "restart_nodes_async",
 ]
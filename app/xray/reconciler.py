@@ -0,0 +1,104 @@
+"""
+Brings the running cores to the users in the database by adding and
+removing clients through the API, instead of restarting them.
+"""
+
+from typing import Dict, Iterable, Optional, Tuple
+
+from app import logger, xray
+from app.xray.config import XRayConfig
+from app.xray.dispatcher import ADD, ALTER, REMOVE, dispatcher
+from xray_api.types.account import Account
+
+
+def _apply_diff(node_id: Optional[int], desired: Dict[Tuple[str, str], Account]) -> int:
+    _, current = dispatcher.state(node_id)
+    changes = 0
+
+    for inbound_tag, email in current.keys() - desired.keys():
+        dispatcher.put(node_id, inbound_tag, email, REMOVE)
+        changes += 1
+
+    for (inbound_tag, email), account in desired.items():
+        existing = current.get((inbound_tag, email))
+        if existing is None:
+            dispatcher.put(node_id, inbound_tag, email, ADD, account)
+            changes += 1
+        elif existing != account:
+            dispatcher.put(node_id, inbound_tag, email, ALTER, account)
+            changes += 1
+
+    return changes
+
+
+def reconcile(config: XRayConfig = None):
+    """
+    Applies the difference between the users in the database and the
+    clients of the main core and every connected node.
+
+    A core is restarted only when it isn't running or its inbounds or
+    outbounds differ from the config (e.g. the core config was modified).
+    """
+    if config is None:
+        config = xray.config.include_db_users()
+    desired = config.get_clients()
+
+    fingerprint, _ = dispatcher.state(None)
+    if not xray.core.started or fingerprint != config.fingerprint:
+        xray.core.restart(config)
+    else:
+        changes = _apply_diff(None, desired)
+        logger.info(f"Reconciled main Xray core, {changes} clients changed")
+
+    for node_id, node in list(xray.nodes.items()):
+        if not node.connected:
+            continue
+
+        fingerprint, _ = dispatcher.state(node_id)
+        if fingerprint != config.fingerprint:
+            xray.operations.restart_node(node_id, config)
+        else:
+            changes = _apply_diff(node_id, desired)
+            logger.info(f"Reconciled Xray core of node {node_id}, {changes} clients changed")
+
+
+def reconcile_stale(config: XRayConfig = None, skip: Iterable[int] = ()):
+    """
+    Applies the operations lost while a core was unreachable, by reconciling
+    the cores which lost some and are reachable again.
+
+    Args:
+        config (XRayConfig): Config with the users, generated if there's a core to reconcile.
+        skip (Iterable[int]): IDs of the nodes being restarted.
+    """
+    node_ids = []
+    for node_id in dispatcher.stale():
+        if node_id in skip:
+            continue
+        if node_id is None:
+            reachable = xray.core.started
+        else:
+            node = xray.nodes.get(node_id)
+            reachable = node is not None and node.connected and node.started
+        if reachable:
+            node_ids.append(node_id)
+    if not node_ids:
+        return
+
+    if config is None:
+        config = xray.config.include_db_users()
+    desired = config.get_clients()
+
+    for node_id in node_ids:
+        fingerprint, _ = dispatcher.state(node_id)
+        if fingerprint != config.fingerprint:
+            continue  # restarted with the new config by the health check
+        dispatcher.clear_stale(node_id)
+        changes = _apply_diff(node_id, desired)
+        logger.info(f"Reconciled {'main Xray core' if node_id is None else f'Xray core of node {node_id}'} "
+                    f"after it was unreachable, {changes} clients changed")
+
+
+@xray.core.on_start
+def _on_core_start():
+    dispatcher.reset(None, xray.core.config)
@@ -34,6 +34,9 @@ XRAY_ASSETS_PATH = config("XRAY_ASSETS_PATH", default="/usr/local/share/xray")
 XRAY_EXCLUDE_INBOUND_TAGS = config("XRAY_EXCLUDE_INBOUND_TAGS", default='').split()
 XRAY_SUBSCRIPTION_URL_PREFIX = config("XRAY_SUBSCRIPTION_URL_PREFIX", default="").strip("/")
 XRAY_SUBSCRIPTION_PATH = config("XRAY_SUBSCRIPTION_PATH", default="sub").strip("/")
+XRAY_OPERATIONS_WORKERS = config("XRAY_OPERATIONS_WORKERS", cast=int, default=8)
+XRAY_OPERATIONS_BATCH_SIZE = config("XRAY_OPERATIONS_BATCH_SIZE", cast=int, default=100)
+XRAY_OPERATIONS_QUEUE_SIZE = config("XRAY_OPERATIONS_QUEUE_SIZE", cast=int, default=10000)
 
 TELEGRAM_API_TOKEN = config("TELEGRAM_API_TOKEN", default="")
 TELEGRAM_ADMIN_ID = config(
@@ -64,6 +67,7 @@ V2RAY_SETTINGS_TEMPLATE = config("V2RAY_SETTINGS_TEMPLATE", default="v2ray/setti
 
 USER_AGENT_TEMPLATE = config("USER_AGENT_TEMPLATE", default="user_agent/default.json")
 GRPC_USER_AGENT_TEMPLATE = config("GRPC_USER_AGENT_TEMPLATE", default="user_agent/grpc.json")
+USER_AGENT_RULES_TEMPLATE = config("USER_AGENT_RULES_TEMPLATE", default="user_agent/rules.json")
 
 EXTERNAL_CONFIG = config("EXTERNAL_CONFIG", default="", cast=str)
 LOGIN_NOTIFY_WHITE_LIST = [ip.strip() for ip in config("LOGIN_NOTIFY_WHITE_LIST",
@@ -130,19 +134,43 @@ NOTIFY_DAYS_LEFT = config(
 )
 
 DISABLE_RECORDING_NODE_USAGE = config("DISABLE_RECORDING_NODE_USAGE", cast=bool, default=False)
+# hourly usages older than this many days are compacted into daily ones, 0 keeps them
+USAGE_HOURLY_RETENTION_DAYS = config("USAGE_HOURLY_RETENTION_DAYS", cast=int, default=0)
+# daily usages older than this many months are compacted into monthly ones, 0 keeps them
+USAGE_DAILY_RETENTION_MONTHS = config("USAGE_DAILY_RETENTION_MONTHS", cast=int, default=0)
+# users whose usages are compacted in one transaction
+USAGE_RETENTION_CHUNK_SIZE = config("USAGE_RETENTION_CHUNK_SIZE", cast=int, default=1000)
 
 # headers: profile-update-interval, support-url, profile-title
 SUB_UPDATE_INTERVAL = config("SUB_UPDATE_INTERVAL", default="12")
 SUB_SUPPORT_URL = config("SUB_SUPPORT_URL", default="https://t.me/")
 SUB_PROFILE_TITLE = config("SUB_PROFILE_TITLE", default="Subscription")
 
+# rendered subscriptions are cached per user and client format, 0 size disables the cache
+SUB_CACHE_SIZE = config("SUB_CACHE_SIZE", cast=int, default=10000)
+SUB_CACHE_TTL = config("SUB_CACHE_TTL", cast=int, default=600)
+# subscriptions rendered per second after the hosts or the core config change, 0 disables it
+SUB_PRERENDER_RATE = config("SUB_PRERENDER_RATE", cast=int, default=50)
+# seconds a subscription update with an unchanged user agent isn't written to the database
+SUB_UPDATED_AT_MIN_INTERVAL = config("SUB_UPDATED_AT_MIN_INTERVAL", cast=int, default=60)
+# verified subscription tokens and users' auth snapshots kept in memory, 0 disables the caches
+SUB_AUTH_CACHE_SIZE = config("SUB_AUTH_CACHE_SIZE", cast=int, default=10000)
+
+# seconds the users counts of the system stats are cached, 0 disables the cache
+USERS_COUNTS_CACHE_TTL = config("USERS_COUNTS_CACHE_TTL", cast=int, default=5)
+
 # discord webhook log
 DISCORD_WEBHOOK_URL = config("DISCORD_WEBHOOK_URL", default="")
 
 
 # Interval jobs, all values are in seconds
+NODE_HEARTBEAT_INTERVAL = config("NODE_HEARTBEAT_INTERVAL", cast=int, default=5)
 JOB_CORE_HEALTH_CHECK_INTERVAL = config("JOB_CORE_HEALTH_CHECK_INTERVAL", cast=int, default=10)
 JOB_RECORD_NODE_USAGES_INTERVAL = config("JOB_RECORD_NODE_USAGES_INTERVAL", cast=int, default=30)
 JOB_RECORD_USER_USAGES_INTERVAL = config("JOB_RECORD_USER_USAGES_INTERVAL", cast=int, default=10)
+JOB_FLUSH_USER_USAGES_INTERVAL = config("JOB_FLUSH_USER_USAGES_INTERVAL", cast=int, default=30)
+JOB_FLUSH_SUB_UPDATES_INTERVAL = config("JOB_FLUSH_SUB_UPDATES_INTERVAL", cast=int, default=30)
 JOB_REVIEW_USERS_INTERVAL = config("JOB_REVIEW_USERS_INTERVAL", cast=int, default=10)
+JOB_PRERENDER_SUBSCRIPTIONS_INTERVAL = config("JOB_PRERENDER_SUBSCRIPTIONS_INTERVAL", cast=int, default=10)
 JOB_SEND_NOTIFICATIONS_INTERVAL = config("JOB_SEND_NOTIFICATIONS_INTERVAL", cast=int, default=30)
+JOB_COMPACT_USAGES_INTERVAL = config("JOB_COMPACT_USAGES_INTERVAL", cast=int, default=3600)